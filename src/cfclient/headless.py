@@ -34,6 +34,8 @@ import sys
 import cfclient.utils
 import cflib.crtp
 from cfclient.utils.input import JoystickReader
+from cfclient.utils.periodictimer import PeriodicTimer
+from cfclient.utils.periodictimer import PRIORITY_HOUSEKEEPING
 from cflib.crazyflie import Crazyflie
 
 if os.name == 'posix':
@@ -46,6 +48,9 @@ if os.name == 'posix':
 #   so it doesn't need a windowing system.
 os.environ["SDL_VIDEODRIVER"] = "dummy"
 
+# How often the input latency is written to file (s)
+LATENCY_DUMP_PERIOD = 5.0
+
 
 class HeadlessClient():
     """Crazyflie headless client"""
@@ -66,6 +71,30 @@ class HeadlessClient():
         for d in self._jr.available_devices():
             self._devs.append(d.name)
 
+        self._latency_file = None
+        self._latency_timer = None
+
+    def measure_latency(self, filename, period=LATENCY_DUMP_PERIOD):
+        """Measure the latency of the input path, the histograms are written
+        to filename every period"""
+        self._latency_file = filename
+        self._jr.enable_latency_stats()
+        self._latency_timer = PeriodicTimer(period, self._dump_latency,
+                                            PRIORITY_HOUSEKEEPING)
+        self._latency_timer.start()
+
+    def _dump_latency(self):
+        self._jr.dump_latency_stats(self._latency_file)
+        print(self._jr.latency_summary())
+
+    def record_controller(self, filename, input_device=0):
+        """Record the raw values read from the controller to filename"""
+        try:
+            self._jr.record_input(self._devs[input_device], filename)
+        except ValueError as e:
+            print("Cannot record: {}".format(e))
+            sys.exit(-1)
+
     def setup_controller(self, input_config, input_device=0, xmode=False):
         """Set up the device reader"""
         # Set up the joystick reader
@@ -106,7 +135,8 @@ class HeadlessClient():
                                                      enabled))
 
         self._cf.open_link(link_uri)
-        self._jr.input_updated.add_callback(self._cf.commander.send_setpoint)
+        self._jr.input_updated.add_callback(
+            self._jr.timed_send(self._cf.commander.send_setpoint))
 
     def _connected(self, link):
         """Callback for a successful Crazyflie connection."""
@@ -148,6 +178,15 @@ def main():
     parser.add_argument("-x", "--x-mode", action="store_true",
                         dest="xmode",
                         help="Enable client-side X-mode")
+    parser.add_argument("--record", action="store", type=str,
+                        dest="record", default=None,
+                        help="Record the raw values read from the "
+                             "controller to this file")
+    parser.add_argument("--latency", action="store", type=str,
+                        dest="latency", default=None,
+                        help="Measure the input latency and write the "
+                             "histograms to this file every {:g} "
+                             "s".format(LATENCY_DUMP_PERIOD))
     (args, unused) = parser.parse_known_args()
 
     if args.debug:
@@ -164,6 +203,10 @@ def main():
             headless.setup_controller(input_config=args.input,
                                       input_device=args.controller,
                                       xmode=args.xmode)
+            if args.record:
+                headless.record_controller(args.record, args.controller)
+            if args.latency:
+                headless.measure_latency(args.latency)
             headless.connect_crazyflie(link_uri=args.uri)
         else:
             print("No input-device connected, exiting!")
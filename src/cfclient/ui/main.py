@@ -50,6 +50,7 @@ from PyQt5.QtCore import pyqtSignal
 from PyQt5.QtCore import pyqtSlot
 from PyQt5.QtCore import QDir
 from PyQt5.QtCore import QThread
+from PyQt5.QtCore import QTimer
 from PyQt5.QtCore import QUrl
 from PyQt5.QtWidgets import QAction
 from PyQt5.QtWidgets import QActionGroup
@@ -196,6 +197,14 @@ class MainUI(QtWidgets.QMainWindow, main_window_class):
 
         self.joystickReader = JoystickReader()
         self._active_device = ""
+
+        # Latency of the input path, shown when it is measured
+        self._latency_label = QLabel("")
+        self.statusBar().addPermanentWidget(self._latency_label)
+        self._latency_timer = QTimer(self)
+        self._latency_timer.setInterval(1000)
+        self._latency_timer.timeout.connect(self._update_latency_label)
+        self._latency_timer.start()
         # self.configGroup = QActionGroup(self._menu_mappings, exclusive=True)
 
         self._mux_group = QActionGroup(self._menu_inputdevice, exclusive=True)
@@ -246,20 +255,28 @@ class MainUI(QtWidgets.QMainWindow, main_window_class):
 
         self._disable_input = False
 
+        # The sending is timed when the input latency is measured
+        send_setpoint = self.joystickReader.timed_send(
+            self.cf.commander.send_setpoint)
+        send_velocity_world_setpoint = self.joystickReader.timed_send(
+            self.cf.commander.send_velocity_world_setpoint)
+        send_zdistance_setpoint = self.joystickReader.timed_send(
+            self.cf.commander.send_zdistance_setpoint)
+
         self.joystickReader.input_updated.add_callback(
-            lambda *args: self._disable_input or
-            self.cf.commander.send_setpoint(*args))
+            lambda *args: self._disable_input or send_setpoint(*args))
 
         self.joystickReader.assisted_input_updated.add_callback(
             lambda *args: self._disable_input or
-            self.cf.commander.send_velocity_world_setpoint(*args))
+            send_velocity_world_setpoint(*args))
 
         self.joystickReader.heighthold_input_updated.add_callback(
             lambda *args: self._disable_input or
-            self.cf.commander.send_zdistance_setpoint(*args))
+            send_zdistance_setpoint(*args))
 
         self.joystickReader.hover_input_updated.add_callback(
-            self.cf.commander.send_hover_setpoint)
+            self.joystickReader.timed_send(
+                self.cf.commander.send_hover_setpoint))
 
         # Connection callbacks and signal wrappers for UI protection
         self.cf.connected.add_callback(self.connectionDoneSignal.emit)
@@ -686,6 +703,10 @@ class MainUI(QtWidgets.QMainWindow, main_window_class):
             msg += " ({})".format(map_name)
         return msg
 
+    def _update_latency_label(self):
+        summary = self.joystickReader.latency_summary()
+        self._latency_label.setText(summary or "")
+
     def _update_input_device_footer(self):
         """Update the footer in the bottom of the UI with status for the
         input device and its mapping"""
@@ -757,21 +778,35 @@ class MainUI(QtWidgets.QMainWindow, main_window_class):
         self._update_input_device_footer()
 
     def device_discovery(self, devs):
-        """Called when new devices have been added"""
+        """Called with all the devices when devices have been added or
+        removed, the device menus are created again"""
         for menu in self._all_role_menus:
             role_menu = menu["rolemenu"]
             mux_menu = menu["muxmenu"]
+            (mux, sub_nodes) = mux_menu.data()
+            role = str(role_menu.title()).strip()
+            for child in role_menu.children():
+                if isinstance(child, (QMenu, QActionGroup)):
+                    child.deleteLater()
+            role_menu.clear()
             dev_group = QActionGroup(role_menu, exclusive=True)
             for d in devs:
                 dev_node = QAction(d.name, role_menu, checkable=True,
                                    enabled=True)
                 role_menu.addAction(dev_node)
                 dev_group.addAction(dev_node)
+                # Show the devices already in use without opening them again
+                in_use = mux._devs.get(role) is d
+                if in_use:
+                    dev_node.blockSignals(True)
+                    dev_node.setChecked(True)
+                    dev_node.blockSignals(False)
                 dev_node.toggled.connect(self._inputdevice_selected)
 
                 map_node = None
                 if d.supports_mapping:
-                    map_node = QMenu("    Input map", role_menu, enabled=False)
+                    map_node = QMenu("    Input map", role_menu,
+                                     enabled=in_use)
                     map_group = QActionGroup(role_menu, exclusive=True)
                     # Connect device node to map node for easy
                     # enabling/disabling when selection changes and device
@@ -792,6 +827,10 @@ class MainUI(QtWidgets.QMainWindow, main_window_class):
                             last_map = Config().get("device_config_mapping")
                             if d.name in last_map and last_map[d.name] == c:
                                 node.setChecked(True)
+                        elif d.input_map and d.input_map_name == c:
+                            node.blockSignals(True)
+                            node.setChecked(True)
+                            node.blockSignals(False)
                     role_menu.addMenu(map_node)
                 dev_node.setData((map_node, d, mux_menu))
 
@@ -806,27 +845,32 @@ class MainUI(QtWidgets.QMainWindow, main_window_class):
         # the roles
         for mux_node in self._all_mux_nodes:
             (mux, sub_nodes) = mux_node.data()
-            if len(mux.supported_roles()) <= len(self._available_devices):
-                mux_node.setEnabled(True)
+            mux_node.setEnabled(
+                len(mux.supported_roles()) <= len(self._available_devices))
 
         # TODO: Currently only supports selecting default mux
-        if self._all_mux_nodes[0].isEnabled():
+        if self._all_mux_nodes[0].isEnabled() and \
+                not self._mux_group.checkedAction():
             self._all_mux_nodes[0].setChecked(True)
 
-        # If the previous length of the available devies was 0, then select
-        # the default on. If that's not available then select the first
-        # on in the list.
+        # If none of the devices is used (at startup or when the used device
+        # was removed), then select the default one. If that's not available
+        # then select the first on in the list.
         # TODO: This will only work for the "Normal" mux so this will be
         #       selected by default
-        if Config().get("input_device") in [d.name for d in devs]:
-            for dev_menu in self._all_role_menus[0]["rolemenu"].actions():
-                if dev_menu.text() == Config().get("input_device"):
-                    dev_menu.setChecked(True)
-        else:
-            # Select the first device in the first mux (will always be "Normal"
-            # mux)
-            self._all_role_menus[0]["rolemenu"].actions()[0].setChecked(True)
-            logger.info("Select first device")
+        used = [d for d in self.joystickReader._selected_mux.devices()
+                if d in devs]
+        if devs and not used:
+            if Config().get("input_device") in [d.name for d in devs]:
+                for dev_menu in self._all_role_menus[0]["rolemenu"].actions():
+                    if dev_menu.text() == Config().get("input_device"):
+                        dev_menu.setChecked(True)
+            else:
+                # Select the first device in the first mux (will always be
+                # "Normal" mux)
+                self._all_role_menus[0]["rolemenu"].actions()[0].setChecked(
+                    True)
+                logger.info("Select first device")
 
         self._update_input_device_footer()
 
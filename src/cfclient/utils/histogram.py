@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#     ||          ____  _ __
+#  +------+      / __ )(_) /_______________ _____  ___
+#  | 0xBC |     / __  / / __/ ___/ ___/ __ `/_  / / _ \
+#  +------+    / /_/ / / /_/ /__/ /  / /_/ / / /_/  __/
+#   ||  ||    /_____/_/\__/\___/_/   \__,_/ /___/\___/
+#
+#  Copyright (C) 2013-2014 Bitcraze AB
+#
+#  Crazyflie Nano Quadcopter Client
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License along with
+#  this program; if not, write to the Free Software Foundation, Inc., 51
+#  Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Histogram used to keep track of timing, like timer jitter and latencies.
+"""
+
+import bisect
+from threading import Lock
+
+__author__ = 'Bitcraze AB'
+__all__ = ['Histogram', 'TIMING_BOUNDS']
+
+# Bucket bounds (s) suitable for timing in the input and control loops
+TIMING_BOUNDS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02,
+                 0.05, 0.1)
+
+
+class Histogram():
+    """Counts values in buckets with fixed upper bounds, the last bucket
+    counts the values above the highest bound"""
+
+    def __init__(self, bounds=TIMING_BOUNDS):
+        self._bounds = list(bounds)
+        # Values are added and read from different threads
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counts = [0] * (len(self._bounds) + 1)
+            self._count = 0
+            self._total = 0.0
+            self._max = 0.0
+
+    def add(self, value):
+        with self._lock:
+            self._counts[bisect.bisect_left(self._bounds, value)] += 1
+            self._count += 1
+            self._total += value
+            self._max = max(self._max, value)
+
+    @property
+    def count(self):
+        return self._count
+
+    def percentile(self, p):
+        """Return the upper bound of the bucket holding the p (0 to 1)
+        percentile, None if it is above the highest bound"""
+        with self._lock:
+            target = p * self._count
+            seen = 0
+            for (bound, count) in zip(self._bounds, self._counts):
+                seen += count
+                if seen >= target and seen > 0:
+                    return bound
+        return None
+
+    def as_dict(self):
+        """Return the histogram as a dict that can be serialized to JSON,
+        buckets are [upper bound, count] with None as the last bound"""
+        with self._lock:
+            return {"count": self._count,
+                    "mean": self._total / self._count if self._count else 0,
+                    "max": self._max,
+                    "buckets": [[b, c] for (b, c) in
+                                zip(self._bounds + [None], self._counts)]}
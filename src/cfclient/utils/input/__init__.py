@@ -41,9 +41,12 @@ configuration file.
 import os
 import re
 import glob
+import sys
+import time
 import traceback
 import logging
 import shutil
+from threading import Lock
 
 from . import inputreaders as readers
 from . import inputinterfaces as interfaces
@@ -53,11 +56,24 @@ from cfclient.utils.config import Config
 from cfclient.utils.config_manager import ConfigManager
 
 from cfclient.utils.periodictimer import PeriodicTimer
+from cfclient.utils.periodictimer import PRIORITY_CONTROL
+from cfclient.utils.periodictimer import PRIORITY_HOUSEKEEPING
 from cflib.utils.callbacks import Caller
+from .eventreader import EventReader
+from .inputreaders import InputDevice
+from .inputrecording import InputRecorder
+from .inputrecording import ReplayReader
+from .latency import InputLatency
 from .mux.nomux import NoMux
 from .mux.takeovermux import TakeOverMux
 from .mux.takeoverselectivemux import TakeOverSelectiveMux
 
+try:
+    from .devicewatcher import DeviceWatcher
+except Exception:
+    # Only available on Linux
+    DeviceWatcher = None
+
 __author__ = 'Bitcraze AB'
 __all__ = ['JoystickReader']
 
@@ -69,6 +85,38 @@ MAX_TARGET_HEIGHT = 1.0
 MIN_TARGET_HEIGHT = 0.03
 MIN_HOVER_HEIGHT = 0.20
 INPUT_READ_PERIOD = 0.01
+# Highest rate set-points are sent at when reading on device events
+INPUT_MAX_RATE = 250
+# Longest time step used when integrating the target height, longer pauses
+# between reads (the input was paused) are not integrated
+MAX_INPUT_DT = 0.1
+# Directory watched for devices being plugged in and removed
+INPUT_DEVICE_DIR = "/dev/input"
+# Nodes in INPUT_DEVICE_DIR the input readers open
+INPUT_DEVICE_NODES = ("js", "event")
+# Time without device changes before looking for devices again, a device
+# being plugged in gives several changes in a row
+DEVICE_SETTLE_TIME = 0.25
+
+
+class _TimedCaller(Caller):
+    """Caller for set-points that times each callback when the latency is
+    measured"""
+
+    def __init__(self, reader, name):
+        super(_TimedCaller, self).__init__()
+        self._reader = reader
+        self._name = name
+
+    def call(self, *args):
+        latency = self._reader._latency
+        if latency is None:
+            return super(_TimedCaller, self).call(*args)
+        for (i, cb) in enumerate(list(self.callbacks)):
+            start = time.monotonic()
+            cb(*args)
+            latency.add("callback {}[{}]".format(self._name, i),
+                        time.monotonic() - start)
 
 
 class JoystickReader(object):
@@ -143,12 +191,25 @@ class JoystickReader(object):
         self._available_devices = {}
 
         # TODO: The polling interval should be set from config file
-        self._read_timer = PeriodicTimer(INPUT_READ_PERIOD, self.read_input)
-
-        if do_device_discovery:
-            self._discovery_timer = PeriodicTimer(1.0,
-                                                  self._do_device_discovery)
-            self._discovery_timer.start()
+        if (sys.platform.startswith("linux") and
+                Config().get("input_event_driven")):
+            # Read as soon as the devices have new events and keep sending
+            # set-points every INPUT_READ_PERIOD if nothing happens
+            self._read_timer = EventReader(self.read_input,
+                                           self._input_filenos,
+                                           INPUT_READ_PERIOD,
+                                           1.0 / INPUT_MAX_RATE)
+        else:
+            self._read_timer = PeriodicTimer(INPUT_READ_PERIOD,
+                                             self.read_input,
+                                             PRIORITY_CONTROL)
+        self._last_read = None
+        # Held while reading the devices and while looking for devices, so
+        # a device is not closed by a rescan in the middle of a read
+        self._read_lock = Lock()
+        # Clock used for the time between reads, replaced when replaying
+        self.clock = time.monotonic
+        self._latency = None
 
         # Check if user config exists, otherwise copy files
         if not os.path.exists(ConfigManager().configs_dir):
@@ -165,10 +226,12 @@ class JoystickReader(object):
 
         ConfigManager().get_list_of_configs()
 
-        self.input_updated = Caller()
-        self.assisted_input_updated = Caller()
-        self.heighthold_input_updated = Caller()
-        self.hover_input_updated = Caller()
+        self.input_updated = _TimedCaller(self, "input_updated")
+        self.assisted_input_updated = _TimedCaller(self,
+                                                   "assisted_input_updated")
+        self.heighthold_input_updated = _TimedCaller(
+            self, "heighthold_input_updated")
+        self.hover_input_updated = _TimedCaller(self, "hover_input_updated")
         self.rp_trim_updated = Caller()
         self.emergency_stop_updated = Caller()
         self.device_discovery = Caller()
@@ -180,6 +243,24 @@ class JoystickReader(object):
         # Call with 3 bools (rp_limiting, yaw_limiting, thrust_limiting)
         self.limiting_updated = Caller()
 
+        self.enable_latency_stats(Config().get("input_latency_stats"))
+
+        self._device_watcher = None
+        if do_device_discovery and DeviceWatcher:
+            try:
+                self._device_watcher = DeviceWatcher(INPUT_DEVICE_DIR,
+                                                     self._devices_changed,
+                                                     DEVICE_SETTLE_TIME)
+            except Exception as e:
+                logger.info("Polling for input devices, could not watch "
+                            "for them: {}".format(e))
+        if do_device_discovery:
+            # When watching, the timer only does the first discovery
+            self._discovery_timer = PeriodicTimer(1.0,
+                                                  self._do_device_discovery,
+                                                  PRIORITY_HOUSEKEEPING)
+            self._discovery_timer.start()
+
     def _get_device_from_name(self, device_name):
         """Get the raw device from a name"""
         for d in readers.devices():
@@ -199,10 +280,24 @@ class JoystickReader(object):
         for d in devs:
             d.input = self
 
-        if len(devs):
+        if len(devs) or self._device_watcher:
             self.device_discovery.call(devs)
             self._discovery_timer.stop()
 
+    def _devices_changed(self, changes):
+        """Called from the device watcher thread once added or removed
+        devices have settled, looks for the devices again there so the
+        timers are not held up"""
+        changes = [(change, name) for (change, name) in changes
+                   if name.startswith(INPUT_DEVICE_NODES)]
+        if not changes:
+            return
+        logger.info("Input devices changed: {}".format(changes))
+        with self._read_lock:
+            readers.devices(rescan=True)
+            devs = self.available_devices()
+        self.device_discovery.call(devs)
+
     def available_mux(self):
         return self._mux
 
@@ -229,8 +324,7 @@ class JoystickReader(object):
         """List all available and approved input devices.
         This function will filter available devices by using the
         blacklist configuration and only return approved devices."""
-        devs = readers.devices()
-        devs += interfaces.devices()
+        devs = readers.devices() + interfaces.devices()
         approved_devs = []
 
         for dev in devs:
@@ -346,6 +440,141 @@ class JoystickReader(object):
         self._read_timer.stop()
         self._selected_mux.pause()
 
+    def read_timer_stats(self):
+        """Return the timing statistics of the input read loop"""
+        return self._read_timer.stats()
+
+    def enable_latency_stats(self, enabled=True):
+        """Start or stop measuring the latency of the input path"""
+        if not enabled:
+            self._latency = None
+        elif not self._latency:
+            self._latency = InputLatency()
+
+    def latency_stats(self):
+        """Return the latency histograms of the input path, None if the
+        latency is not measured"""
+        if self._latency:
+            return self._latency.stats()
+        return None
+
+    def latency_summary(self):
+        """Return a short text about the input latency, None if the latency
+        is not measured"""
+        if self._latency:
+            return self._latency.summary()
+        return None
+
+    def dump_latency_stats(self, filename):
+        """Write the latency histograms to filename as JSON"""
+        if self._latency:
+            self._latency.dump(filename)
+
+    def timed_send(self, send):
+        """Wrap a function sending set-points to the Crazyflie so the time
+        spent in it is counted when the latency is measured"""
+        def timed(*args):
+            latency = self._latency
+            if latency is None:
+                return send(*args)
+            latency.timed_send(send, *args)
+        return timed
+
+    def record_input(self, device_name, filename):
+        """Record the raw values read from a device to filename, returns the
+        InputRecorder, stop it to end the recording"""
+        device = self._get_device_from_name(device_name)
+        if device is None:
+            raise ValueError("No input device named {}".format(device_name))
+        return InputRecorder(device, filename)
+
+    def replay(self, recordings, input_maps=None, realtime=False):
+        """Read input recordings through read_input, with the recorded
+        devices in the roles of the selected mux. recordings is the file of
+        the first role or {role: file}, input_maps the name of the input map
+        of all the devices or {role: name}. The settings of the map of the
+        first role are used. The frames are read as fast as possible or at
+        the recorded times, the recorded times are used as clock in both
+        cases so the result is the same. Input reading is paused, resume it
+        with resume_input() afterwards. Returns the number of frames
+        read."""
+        roles = self._selected_mux.supported_roles()
+        if not isinstance(recordings, dict):
+            recordings = {roles[0]: recordings}
+        if not recordings:
+            raise Exception("No recording to replay")
+        unknown = [role for role in recordings if role not in roles]
+        if unknown:
+            raise Exception("MUX {} has no role {}".format(
+                self._selected_mux.name, unknown[0]))
+        if not isinstance(input_maps, dict):
+            input_maps = dict((role, input_maps) for role in recordings)
+
+        replay_readers = []
+        devices = {}
+        first_settings = None
+        for role in [role for role in roles if role in recordings]:
+            reader = ReplayReader(recordings[role])
+            device = InputDevice(reader.devices()[0]["name"], 0, reader)
+            device.input = self
+            device.clock = lambda reader=reader: reader.time
+            map_name = input_maps.get(role)
+            settings = ConfigManager().get_settings(map_name)
+            if settings:
+                if not replay_readers:
+                    first_settings = settings
+                device.input_map = ConfigManager().get_config(map_name)
+                device.input_map_name = map_name
+            replay_readers.append(reader)
+            devices[role] = device
+
+        springy_throttle = self.springy_throttle
+        rp_dead_band = self._rp_dead_band
+        if first_settings:
+            self.springy_throttle = first_settings["springythrottle"]
+            self._rp_dead_band = first_settings["rp_dead_band"]
+        for device in devices.values():
+            device.set_dead_band(self._rp_dead_band)
+
+        self.pause_input()
+        old_mux_devices = self._selected_mux.swap_devices(devices)
+        # The first role sets the time
+        clock_reader = replay_readers[0]
+        self.clock = lambda: clock_reader.time
+        self._last_read = None
+        frames = 0
+        start = time.monotonic()
+        try:
+            while not all([r.finished for r in replay_readers]):
+                if realtime:
+                    next_time = min([r.next_time() for r in replay_readers
+                                     if not r.finished])
+                    wait = next_time - (time.monotonic() - start)
+                    if wait > 0:
+                        time.sleep(wait)
+                self.read_input()
+                frames += 1
+        finally:
+            self.clock = time.monotonic
+            self._last_read = None
+            self._selected_mux.swap_devices(old_mux_devices)
+            self.springy_throttle = springy_throttle
+            self._rp_dead_band = rp_dead_band
+        return frames
+
+    def _input_filenos(self):
+        return self._selected_mux.filenos()
+
+    def _read_dt(self):
+        """Return the time since the previous read, for integrating the
+        set-points"""
+        now = self.clock()
+        dt = INPUT_READ_PERIOD
+        if self._last_read is not None:
+            dt = min(now - self._last_read, MAX_INPUT_DT)
+        self._last_read = now
+        return dt
+
     def _set_thrust_slew_rate(self, rate):
         self._thrust_slew_rate = rate
         if rate > 0:
@@ -358,8 +587,15 @@ class JoystickReader(object):
 
     def read_input(self):
         """Read input data from the selected device"""
+        latency = self._latency
+        if latency:
+            latency.start_read()
         try:
-            data = self._selected_mux.read()
+            with self._read_lock:
+                data = self._selected_mux.read()
+            dt = self._read_dt()
+            if latency and data:
+                latency.devices_read(self._selected_mux.devices())
 
             if data:
                 if data.toggled.assistedControl:
@@ -456,7 +692,7 @@ class JoystickReader(object):
                     # Scale thrust to a value between -1.0 to 1.0
                     vz = (data.thrust - 32767) / 32767.0
                     # Integrate velosity setpoint
-                    self._target_height += vz * INPUT_READ_PERIOD
+                    self._target_height += vz * dt
                     # Cap target height
                     if self._target_height > MAX_TARGET_HEIGHT:
                         self._target_height = MAX_TARGET_HEIGHT
@@ -493,7 +729,7 @@ class JoystickReader(object):
                         # Scale thrust to a value between -1.0 to 1.0
                         vz = (data.thrust - 32767) / 32767.0
                         # Integrate velosity setpoint
-                        self._target_height += vz * INPUT_READ_PERIOD
+                        self._target_height += vz * dt
                         # Cap target height
                         if self._target_height > MAX_TARGET_HEIGHT:
                             self._target_height = MAX_TARGET_HEIGHT
@@ -526,6 +762,8 @@ class JoystickReader(object):
                                    traceback.format_exc())
             self.input_updated.call(0, 0, 0, 0)
             self._read_timer.stop()
+        if latency:
+            latency.end_read()
 
     @staticmethod
     def p2t(percentage):
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#     ||          ____  _ __
+#  +------+      / __ )(_) /_______________ _____  ___
+#  | 0xBC |     / __  / / __/ ___/ ___/ __ `/_  / / _ \
+#  +------+    / /_/ / / /_/ /__/ /  / /_/ / / /_/  __/
+#   ||  ||    /_____/_/\__/\___/_/   \__,_/ /___/\___/
+#
+#  Copyright (C) 2014 Bitcraze AB
+#
+#  Crazyflie Nano Quadcopter Client
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+#  02110-1301, USA.
+"""
+Watches a device directory (/dev/input) with inotify and reports when
+device nodes are added or removed, so devices are found again right away
+instead of by scanning periodically.
+
+inotify is used through ctypes, this module is Linux only.
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import selectors
+import struct
+import sys
+import time
+from threading import Thread
+
+if not sys.platform.startswith('linux'):
+    raise Exception("Only supported on Linux")
+
+__author__ = 'Bitcraze AB'
+__all__ = ['DeviceWatcher']
+
+logger = logging.getLogger(__name__)
+
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_CLOEXEC = 0o2000000
+
+# Permissions are often set after the node is created, when they change the
+# device might have become readable so it is reported as added again
+IN_ADDED = IN_CREATE | IN_MOVED_TO | IN_ATTRIB
+IN_REMOVED = IN_DELETE | IN_MOVED_FROM
+
+INOTIFY_EVENT = struct.Struct("iIII")
+INOTIFY_READ_SIZE = 4096
+
+ADDED = "added"
+REMOVED = "removed"
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+
+class DeviceWatcher:
+    """Calls callback with a list of (ADDED or REMOVED, name) when nodes in
+    path are added or removed. Changes are collected until none has been
+    seen for settle_time seconds and then reported in one call, from the
+    watcher thread, so a device creating several nodes is reported once."""
+
+    def __init__(self, path, callback, settle_time=0):
+        self._callback = callback
+        self._settle_time = settle_time
+        self._fd = _libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = _libc.inotify_add_watch(self._fd, path.encode(),
+                                     IN_ADDED | IN_REMOVED)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, "Could not watch {}: {}".format(
+                path, os.strerror(errno)))
+        (self._wake_r, self._wake_w) = os.pipe()
+        self._running = True
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info("Watching {} for devices".format(path))
+
+    def stop(self):
+        """Stop watching"""
+        if self._running:
+            self._running = False
+            os.write(self._wake_w, b"\0")
+
+    @staticmethod
+    def _decode(data):
+        changes = []
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            (_, mask, _, length) = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if not name:
+                continue
+            change = ADDED if mask & IN_ADDED else REMOVED
+            changes.append((change, name.decode("UTF-8", "replace")))
+        return changes
+
+    def _run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self._fd, selectors.EVENT_READ)
+        selector.register(self._wake_r, selectors.EVENT_READ)
+        changes = []
+        changed_at = None
+        try:
+            while self._running:
+                timeout = None
+                if changes:
+                    timeout = max(0, changed_at + self._settle_time -
+                                  time.monotonic())
+                for (key, _) in selector.select(timeout):
+                    if key.fd != self._fd or not self._running:
+                        continue
+                    read = self._decode(os.read(self._fd, INOTIFY_READ_SIZE))
+                    if read:
+                        changes += read
+                        changed_at = time.monotonic()
+                if (changes and self._running and
+                        time.monotonic() - changed_at >= self._settle_time):
+                    try:
+                        self._callback(changes)
+                    except Exception:
+                        logger.exception("Error when reporting device "
+                                         "changes")
+                    changes = []
+        finally:
+            selector.close()
+            os.close(self._fd)
+            os.close(self._wake_r)
+            os.close(self._wake_w)
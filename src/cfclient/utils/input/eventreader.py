@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#     ||          ____  _ __
+#  +------+      / __ )(_) /_______________ _____  ___
+#  | 0xBC |     / __  / / __/ ___/ ___/ __ `/_  / / _ \
+#  +------+    / /_/ / / /_/ /__/ /  / /_/ / / /_/  __/
+#   ||  ||    /_____/_/\__/\___/_/   \__,_/ /___/\___/
+#
+#  Copyright (C) 2014 Bitcraze AB
+#
+#  Crazyflie Nano Quadcopter Client
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+#  02110-1301, USA.
+"""
+Event driven alternative to reading the input devices with a periodic timer.
+
+A thread waits (epoll/select) on the file descriptors of the opened devices
+and calls the callback as soon as one of them has new events, so a set-point
+is sent right after the stick has moved instead of at the next timer tick.
+The calls are capped to a maximum rate and if nothing happens the callback is
+still called every keep-alive period, so devices without a file descriptor
+are read and the Crazyflie keeps getting set-points.
+"""
+import logging
+import os
+import selectors
+import time
+from threading import Thread
+
+from cfclient.utils.histogram import Histogram
+
+__author__ = 'Bitcraze AB'
+__all__ = ['EventReader']
+
+logger = logging.getLogger(__name__)
+
+
+class EventReader:
+    """Calls callback when one of the file descriptors returned by filenos
+    is readable, at most every min_period and at least every keepalive
+    seconds. Has the same start/stop/stats interface as PeriodicTimer."""
+
+    def __init__(self, callback, filenos, keepalive, min_period):
+        self._callback = callback
+        self._filenos = filenos
+        self._keepalive = keepalive
+        self._min_period = min_period
+        self._thread = None
+        # Used to wake up the thread when stopped
+        (self._wake_r, self._wake_w) = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        self._delay = Histogram()
+        self.reset_stats()
+
+    def stats(self):
+        """Return the number of calls, how many were caused by device events
+        and by the keep-alive, and how long events were held back by the rate
+        cap"""
+        return {"keepalive": self._keepalive, "min_period": self._min_period,
+                "calls": self._calls, "events": self._events,
+                "keepalives": self._keepalives,
+                "rate_limited": self._rate_limited,
+                "delay": self._delay.as_dict()}
+
+    def reset_stats(self):
+        self._calls = 0
+        self._events = 0
+        self._keepalives = 0
+        self._rate_limited = 0
+        self._delay.reset()
+
+    def start(self):
+        """Start calling the callback"""
+        if self._thread:
+            logger.warning("Event reader already started, not restarting")
+            return
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop calling the callback, can be called from the callback"""
+        if self._thread:
+            self._thread = None
+            os.write(self._wake_w, b"\0")
+
+    def _running(self, thread):
+        return self._thread is thread
+
+    def _update(self, selector, registered):
+        """Watch the file descriptors of the devices opened right now"""
+        fds = set(fd for fd in self._filenos() if fd is not None)
+        for fd in registered - fds:
+            selector.unregister(fd)
+        for fd in fds - registered:
+            selector.register(fd, selectors.EVENT_READ)
+        return fds
+
+    def _run(self):
+        thread = self._thread
+        selector = selectors.DefaultSelector()
+        selector.register(self._wake_r, selectors.EVENT_READ)
+        registered = set()
+        last_call = time.monotonic() - self._keepalive
+        try:
+            while self._running(thread):
+                registered = self._update(selector, registered)
+                timeout = max(0, last_call + self._keepalive -
+                              time.monotonic())
+                events = selector.select(timeout)
+                if not self._running(thread):
+                    break
+                device_event = False
+                for (key, _) in events:
+                    if key.fd == self._wake_r:
+                        try:
+                            os.read(self._wake_r, 64)
+                        except BlockingIOError:
+                            pass
+                    else:
+                        device_event = True
+
+                now = time.monotonic()
+                if device_event:
+                    self._events += 1
+                    wait = last_call + self._min_period - now
+                    if wait > 0:
+                        self._rate_limited += 1
+                        self._delay.add(wait)
+                        time.sleep(wait)
+                elif now >= last_call + self._keepalive:
+                    self._keepalives += 1
+                    # A device closed and opened again can get the same file
+                    # descriptor without being watched, register them again
+                    for fd in registered:
+                        selector.unregister(fd)
+                    registered = set()
+                else:
+                    continue
+
+                last_call = time.monotonic()
+                self._calls += 1
+                self._callback()
+        except Exception:
+            # Same as a PeriodicTimer, the reading stops
+            logger.exception("Error in event reader, stopping")
+            if self._running(thread):
+                self._thread = None
+        finally:
+            selector.close()
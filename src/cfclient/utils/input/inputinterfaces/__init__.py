@@ -32,6 +32,8 @@ Find all the available input interfaces and try to initialize them.
 """
 
 import logging
+from time import monotonic
+
 from ..inputreaderinterface import InputReaderInterface
 
 __author__ = 'Bitcraze AB'
@@ -100,8 +102,10 @@ class InputInterface(InputReaderInterface):
 
     def read(self, include_raw=False):
         mydata = self._reader.read(self.id)
+        self.read_time = monotonic()
         # Merge interface returned data into InputReader Data Item
         for key in list(mydata.keys()):
             self.data.set(key, mydata[key])
+        self.mapped_time = monotonic()
 
         return self.data
@@ -36,64 +36,107 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-class _ToggleState(dict):
+_AXES = ("roll", "pitch", "yaw", "thrust")
+_BUTTONS = ("alt1", "alt2", "estop", "exit", "pitchNeg", "pitchPos", "rollNeg",
+            "rollPos", "assistedControl", "muxswitch")
+
+_BUTTON_BIT = dict((name, 1 << i) for (i, name) in enumerate(_BUTTONS))
+
+
+def _toggle_bit(bit):
+    return property(lambda self: self._data._toggled & bit != 0)
+
+
+class _ToggleState(object):
+    """Tells if each button changed at the last set, from the toggled bits
+    of the input data"""
+    __slots__ = ("_data",)
+
+    alt1 = _toggle_bit(_BUTTON_BIT["alt1"])
+    alt2 = _toggle_bit(_BUTTON_BIT["alt2"])
+    estop = _toggle_bit(_BUTTON_BIT["estop"])
+    exit = _toggle_bit(_BUTTON_BIT["exit"])
+    pitchNeg = _toggle_bit(_BUTTON_BIT["pitchNeg"])
+    pitchPos = _toggle_bit(_BUTTON_BIT["pitchPos"])
+    rollNeg = _toggle_bit(_BUTTON_BIT["rollNeg"])
+    rollPos = _toggle_bit(_BUTTON_BIT["rollPos"])
+    assistedControl = _toggle_bit(_BUTTON_BIT["assistedControl"])
+    muxswitch = _toggle_bit(_BUTTON_BIT["muxswitch"])
+
+    def __init__(self, data):
+        self._data = data
 
     def __getattr__(self, attr):
-        return self.get(attr)
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        # Not a button
+        return None
+
+    def __getitem__(self, key):
+        if key not in _BUTTON_BIT:
+            raise KeyError(key)
+        return getattr(self, key)
 
-    __setattr__ = dict.__setitem__
-    __delattr__ = dict.__delitem__
+    def get(self, key, default=None):
+        if key not in _BUTTON_BIT:
+            return default
+        return getattr(self, key)
 
 
-class InputData:
+class InputData(object):
+    """The axes and buttons of a device, kept in slots. Which buttons changed
+    at the last set is kept as bits (toggled)."""
+    __slots__ = _AXES + _BUTTONS + ("_previous", "_toggled", "_other",
+                                    "toggled")
 
     def __init__(self):
-        # self._toggled = {}
-        self._axes = ("roll", "pitch", "yaw", "thrust")
-        self._buttons = ("alt1", "alt2", "estop", "exit", "pitchNeg",
-                         "pitchPos", "rollNeg", "rollPos", "assistedControl",
-                         "muxswitch")
-        for axis in self._axes:
-            self.__dict__[axis] = 0.0
-        self.toggled = _ToggleState()
-        self._prev_btn_values = {}
-        for button in self._buttons:
-            self.__dict__[button] = False
-            self.toggled[button] = False
-            self._prev_btn_values[button] = False
+        self.reset_axes()
+        self.reset_buttons()
+        # Button values of the previous set, used to find the toggled ones
+        self._previous = dict.fromkeys(_BUTTONS, False)
+        self._toggled = 0
+        # Values set for names that are neither axes nor buttons
+        self._other = {}
+        self.toggled = _ToggleState(self)
 
-    def get_all_indicators(self):
-        return self._axes + self._buttons
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        try:
+            return self._other[attr]
+        except KeyError:
+            raise AttributeError(attr)
 
-    def _check_toggle(self, key, data):
-        if key not in self._prev_btn_values:
-            self._prev_btn_values[key] = data
-        elif self._prev_btn_values[key] != data:
-            self._prev_btn_values[key] = data
-            return True
-        return False
+    def get_all_indicators(self):
+        return _AXES + _BUTTONS
 
     def reset_axes(self):
-        for axis in self._axes:
-            self.__dict__[axis] = 0.0
+        self.roll = self.pitch = self.yaw = self.thrust = 0.0
 
     def reset_buttons(self):
-        for button in self._buttons:
-            self.__dict__[button] = False
+        self.alt1 = self.alt2 = self.estop = self.exit = False
+        self.pitchNeg = self.pitchPos = self.rollNeg = self.rollPos = False
+        self.assistedControl = self.muxswitch = False
 
     def set(self, name, value):
-        try:
-            if name in self._buttons:
-                if self._check_toggle(name, value):
-                    self.toggled[name] = True
-                else:
-                    self.toggled[name] = False
-        except KeyError:
-            pass
-        self.__dict__[name] = value
+        bit = _BUTTON_BIT.get(name)
+        if bit is not None:
+            previous = self._previous
+            if previous[name] != value:
+                previous[name] = value
+                self._toggled |= bit
+            else:
+                self._toggled &= ~bit
+            setattr(self, name, value)
+        elif name in _AXES:
+            setattr(self, name, value)
+        else:
+            self._other[name] = value
 
     def get(self, name):
-        return self.__dict__[name]
+        if name in _BUTTON_BIT or name in _AXES:
+            return getattr(self, name)
+        return self._other[name]
 
 
 class InputReaderInterface(object):
@@ -128,6 +171,17 @@ class InputReaderInterface(object):
 
         self._prev_thrust = 0
         self._last_time = 0
+        # Monotonic time the newest input was received by the kernel, for
+        # readers that know it
+        self.event_time = None
+        # Monotonic times of the last read, when the raw values had been
+        # read and when they had been mapped and limited
+        self.read_time = None
+        self.mapped_time = None
+        # Set to an InputRecorder to record the raw values read
+        self.recorder = None
+        # Clock used for the thrust slew rate, replaced when replaying
+        self.clock = time
         # How low you have to pull the thrust to bypass the slew-rate (0-100%)
         self.thrust_stop_limit = -90
 
@@ -143,6 +197,11 @@ class InputReaderInterface(object):
     def close(self):
         return
 
+    def fileno(self):
+        """Return a file descriptor that is readable when the device has new
+        input, or None if the device has to be polled"""
+        return None
+
     @staticmethod
     def devices():
         """List all the available devices."""
@@ -167,7 +226,7 @@ class InputReaderInterface(object):
     def _limit_thrust(self, thrust, assisted_control, emergency_stop):
         # Thrust limiting (slew, minimum and emergency stop)
 
-        current_time = time()
+        current_time = self.clock()
         if self.input.springy_throttle:
             if assisted_control and \
                     (self.input.get_assisted_control() ==
@@ -246,12 +305,15 @@ class InputReaderInterface(object):
                         emergency_stop):
                     if self._old_thrust > self.input.thrust_slew_limit:
                         self._old_thrust = self.input.thrust_slew_limit
-                    if thrust < (self._old_thrust -
-                                 self.input.thrust_slew_rate / 100):
-                        thrust = (self._old_thrust -
-                                  self.input.thrust_slew_rate / 100)
+                    # Lower by the rate for the time since the last read,
+                    # reads are not always at the same rate
+                    lowering = ((current_time - self._last_time) *
+                                self.input.thrust_slew_rate)
+                    if thrust < self._old_thrust - lowering:
+                        thrust = self._old_thrust - lowering
                     if thrust < -1 or thrust < self.input.min_thrust:
                         thrust = 0
+            self._last_time = current_time
 
         self._old_thrust = thrust
         self._old_raw_thrust = thrust
@@ -34,6 +34,8 @@ directory and it will be picked up automatically.
 """
 
 import logging
+from time import monotonic
+
 from ..inputreaderinterface import InputReaderInterface
 
 __author__ = 'Bitcraze AB'
@@ -46,11 +48,13 @@ logger = logging.getLogger(__name__)
 try:
     from . import pysdl2  # noqa
     from . import linuxjsdev  # noqa
+    from . import linuxevdev  # noqa
 except Exception:
     pass
 
 # Statically listing the available input readers
 input_readers = ["linuxjsdev",
+                 "linuxevdev",
                  "pysdl2"]
 
 logger.info("Input readers: {}".format(input_readers))
@@ -68,15 +72,26 @@ for reader in input_readers:
         logger.info("Could not initialize [{}]: {}".format(reader, e))
 
 
-def devices():
-    # Todo: Support rescanning and adding/removing devices
-    if len(available_devices) == 0:
+def devices(rescan=False):
+    """Return the devices of all readers. With rescan the readers that
+    support it look for devices again, devices still there are kept."""
+    if rescan:
+        for r in initialized_readers:
+            if hasattr(r, "rescan"):
+                r.rescan()
+    if rescan or len(available_devices) == 0:
+        found = []
         for r in initialized_readers:
             devs = r.devices()
             for dev in devs:
-                available_devices.append(InputDevice(dev["name"],
-                                                     dev["id"],
-                                                     r))
+                known = [d for d in available_devices
+                         if d._reader is r and d.id == dev["id"] and
+                         d.name == dev["name"]]
+                if known:
+                    found.append(known[0])
+                else:
+                    found.append(InputDevice(dev["name"], dev["id"], r))
+        available_devices[:] = found
     return available_devices
 
 
@@ -93,6 +108,7 @@ class InputDevice(InputReaderInterface):
         self.limit_thrust = True
         self.limit_yaw = True
         self.db = 0.
+        self._event_time = getattr(dev_reader, "event_time", None)
 
     def open(self):
         # TODO: Reset data?
@@ -101,43 +117,73 @@ class InputDevice(InputReaderInterface):
     def close(self):
         self._reader.close(self.id)
 
+    def fileno(self):
+        fileno = getattr(self._reader, "fileno", None)
+        if fileno:
+            return fileno(self.id)
+        return None
+
     def set_dead_band(self, db):
         self.db = db
 
+    def _get_input_map(self):
+        return self._input_map
+
+    def _set_input_map(self, input_map):
+        """Set the mapping and compile it to the lists used when reading, so
+        the map is not looked up for every axis and button on each read"""
+        self._input_map = input_map
+        self._axis_map = []
+        self._button_map = []
+        if not input_map:
+            return
+        indicators = self.data.get_all_indicators()
+        for (index, entry) in sorted(input_map.items()):
+            try:
+                (kind, number) = index.rsplit("-", 1)
+                number = int(number)
+                if entry["type"] != kind:
+                    continue
+                if kind == "Input.AXIS" and entry["key"] in indicators:
+                    # (a + offset) / scale as a multiply-add
+                    gain = 1.0 / entry["scale"]
+                    self._axis_map.append((number, entry["key"], gain,
+                                           entry["offset"] * gain))
+                elif kind == "Input.BUTTON":
+                    self._button_map.append((number, entry["key"]))
+            except (KeyError, TypeError, ValueError, ZeroDivisionError):
+                logger.warning("Ignoring bad mapping {}".format(index))
+        # Applied in the order of the device indexes, like the raw values
+        self._axis_map.sort(key=lambda m: m[0])
+        self._button_map.sort(key=lambda m: m[0])
+
+    input_map = property(_get_input_map, _set_input_map)
+
     def read(self, include_raw=False):
         [axis, buttons] = self._reader.read(self.id)
+        self.read_time = monotonic()
+        if self.recorder:
+            self.recorder.add(axis, buttons)
+        if self._event_time:
+            self.event_time = self._event_time(self.id)
+        data = self.data
 
         # To support split axis we need to zero all the axis
-        self.data.reset_axes()
+        data.reset_axes()
 
-        i = 0
-        for a in axis:
-            index = "Input.AXIS-%d" % i
-            try:
-                if self.input_map[index]["type"] == "Input.AXIS":
-                    key = self.input_map[index]["key"]
-                    axisvalue = a + self.input_map[index]["offset"]
-                    axisvalue = axisvalue / self.input_map[index]["scale"]
-                    self.data.set(key, axisvalue + self.data.get(key))
-            except (KeyError, TypeError):
-                pass
-            i += 1
+        axis_count = len(axis)
+        for (number, key, gain, bias) in self._axis_map:
+            if number < axis_count:
+                data.set(key, axis[number] * gain + bias + data.get(key))
 
         # Workaround for fixing issues during mapping (remapping buttons while
         # they are pressed.
-        self.data.reset_buttons()
+        data.reset_buttons()
 
-        i = 0
-        for b in buttons:
-            index = "Input.BUTTON-%d" % i
-            try:
-                if self.input_map[index]["type"] == "Input.BUTTON":
-                    key = self.input_map[index]["key"]
-                    self.data.set(key, True if b == 1 else False)
-            except (KeyError, TypeError):
-                # Button not mapped, ignore..
-                pass
-            i += 1
+        button_count = len(buttons)
+        for (number, key) in self._button_map:
+            if number < button_count:
+                data.set(key, buttons[number] == 1)
 
         self.data.roll = InputDevice.deadband(self.data.roll, self.db)
         self.data.pitch = InputDevice.deadband(self.data.pitch, self.db)
@@ -152,6 +198,8 @@ class InputDevice(InputReaderInterface):
         if self.limit_yaw:
             self.data.yaw = self._scale_and_deadband_yaw(self.data.yaw)
 
+        self.mapped_time = monotonic()
+
         if include_raw:
             return [axis, buttons, self.data]
         else:
@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+#     ||
+#  +------+      / __ )(_) /_______________ _____  ___
+#  | 0xBC |     / __  / / __/ ___/ ___/ __ `/_  / / _ \
+#  +------+    / /_/ / / /_/ /__/ /  / /_/ / / /_/  __/
+#   ||  ||    /_____/_/\__/\___/_/   \__,_/ /___/\___/
+#
+#  Copyright (C) 2011-2013 Bitcraze AB
+#
+#  Crazyflie Nano Quadcopter Client
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Linux evdev implementation of the input reader. Reads /dev/input/event*
+with the evdev ioctls, which gives the full resolution of the axes and the
+time the kernel received each event.
+
+The axes and buttons are numbered in the same order as the Linux joystick
+driver (jsdev) does, so the input maps made for linuxjsdev can be used. The
+event timestamps are taken from the monotonic clock, like time.monotonic().
+
+This reader is used instead of linuxjsdev when enable_evdev_input is set in
+the configuration.
+"""
+import ctypes
+import glob
+import logging
+import os
+import struct
+import sys
+import time
+
+from cfclient.utils.config import Config
+
+if not sys.platform.startswith('linux'):
+    raise Exception("Only supported on Linux")
+
+if not Config().get("enable_evdev_input"):
+    raise Exception("evdev input disabled in config file")
+
+try:
+    import fcntl
+except ImportError as e:
+    raise Exception("fcntl library probably not installed ({})".format(e))
+
+__author__ = 'Bitcraze AB'
+__all__ = ['EvdevReader']
+
+logger = logging.getLogger(__name__)
+
+MODULE_MAIN = "EvdevReader"
+MODULE_NAME = "linuxevdev"
+
+# struct input_event: struct timeval, type, code, value
+EV_EVENT = struct.Struct("@llHHi")
+# struct input_absinfo: value, minimum, maximum, fuzz, flat, resolution
+EV_ABSINFO = struct.Struct("@6i")
+# Number of events read from the device at a time
+EV_READ_EVENTS = 64
+
+EV_SYN = 0x00
+EV_KEY = 0x01
+EV_ABS = 0x03
+SYN_REPORT = 0
+SYN_DROPPED = 3
+
+KEY_MAX = 0x2ff
+ABS_MAX = 0x3f
+BTN_MISC = 0x100
+BTN_JOYSTICK = 0x120
+BTN_DIGI = 0x140
+
+CLOCK_MONOTONIC = 1
+
+
+def _ioc(direction, nr, size):
+    return (direction << 30) | (size << 16) | (ord("E") << 8) | nr
+
+
+def _eviocgbit(ev, size):
+    return _ioc(2, 0x20 + ev, size)
+
+
+def _eviocgabs(code):
+    return _ioc(2, 0x40 + code, EV_ABSINFO.size)
+
+
+EVIOCGKEY = _ioc(2, 0x18, (KEY_MAX + 8) // 8)
+EVIOCSCLOCKID = _ioc(1, 0xa0, ctypes.sizeof(ctypes.c_int))
+
+
+def _bits(data):
+    """Return the numbers of the bits set in a kernel bitmap"""
+    value = int.from_bytes(data, sys.byteorder)
+    return [i for i in range(len(data) * 8) if value >> i & 1]
+
+
+def _is_joystick(path):
+    """Tell if the event device at sysfs path has joystick buttons, the
+    kernel uses the same test to create a js device"""
+    try:
+        with open(path + "/device/capabilities/key") as f:
+            words = f.read().split()
+    except IOError:
+        return False
+    width = struct.calcsize("l") * 2
+    keys = int("".join(w.zfill(width) for w in words) or "0", 16)
+    return keys >> BTN_JOYSTICK & ((1 << (BTN_DIGI - BTN_JOYSTICK)) - 1) != 0
+
+
+class _Axis():
+    """Scales the raw value of an axis to -1..1, with the flat range around
+    the center read as 0 like the joystick driver does"""
+
+    def __init__(self, absinfo):
+        (_, minimum, maximum, _, flat, _) = absinfo
+        self.center = (minimum + maximum) / 2.0
+        self.flat = flat
+        half = (maximum - minimum) / 2.0 - flat
+        self.scale = 1.0 / half if half > 0 else 0.0
+
+    def value(self, raw):
+        offset = raw - self.center
+        if offset > self.flat:
+            value = (offset - self.flat) * self.scale
+        elif offset < -self.flat:
+            value = (offset + self.flat) * self.scale
+        else:
+            return 0.0
+        return max(-1.0, min(1.0, value))
+
+
+class _Evdev():
+
+    def __init__(self, num, name):
+        self.num = num
+        self.name = name
+        self._f_name = "/dev/input/event{}".format(num)
+        self._fd = None
+
+        self.axes = []
+        self.buttons = []
+        # Monotonic time of the newest event, None until an event is read
+        self.event_time = None
+        self._axes = {}
+        self._buttons = {}
+        self._time_offset = 0.0
+        # Set when the kernel has dropped events, until the next report
+        self._dropping = False
+
+    def open(self):
+        if self._fd is not None:
+            raise Exception("{} at {} is already "
+                            "opened".format(self.name, self._f_name))
+
+        self._fd = os.open(self._f_name, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            self._time_offset = 0.0
+            try:
+                fcntl.ioctl(self._fd, EVIOCSCLOCKID,
+                            ctypes.c_int(CLOCK_MONOTONIC))
+            except IOError:
+                # Older kernels only give the wall clock time
+                self._time_offset = time.monotonic() - time.time()
+
+            abs_bits = bytearray((ABS_MAX + 8) // 8)
+            fcntl.ioctl(self._fd, _eviocgbit(EV_ABS, len(abs_bits)), abs_bits)
+            key_bits = bytearray((KEY_MAX + 8) // 8)
+            fcntl.ioctl(self._fd, _eviocgbit(EV_KEY, len(key_bits)), key_bits)
+        except IOError:
+            os.close(self._fd)
+            self._fd = None
+            raise Exception("Failed to read the axes and buttons of "
+                            "{}".format(self._f_name))
+
+        # Numbered like the joystick driver, buttons from BTN_JOYSTICK first
+        keys = _bits(key_bits)
+        keys = ([k for k in keys if k >= BTN_JOYSTICK] +
+                [k for k in keys if BTN_MISC <= k < BTN_JOYSTICK])
+        self._axes = {}
+        for code in _bits(abs_bits):
+            self._axes[code] = (len(self._axes),
+                                _Axis(self._absinfo(code)))
+        self._buttons = dict((code, i) for (i, code) in enumerate(keys))
+        self.axes = [0.0] * len(self._axes)
+        self.buttons = [0] * len(self._buttons)
+        self.event_time = None
+        self._dropping = False
+        self._sync()
+
+    def close(self):
+        """Close the device"""
+        if self._fd is None:
+            return
+
+        logger.info("Closed {} ({})".format(self.name, self.num))
+
+        os.close(self._fd)
+        self._fd = None
+
+    def fileno(self):
+        """Return the file descriptor of the opened device or None"""
+        return self._fd
+
+    def _absinfo(self, code):
+        absinfo = bytearray(EV_ABSINFO.size)
+        fcntl.ioctl(self._fd, _eviocgabs(code), absinfo)
+        return EV_ABSINFO.unpack(absinfo)
+
+    def _sync(self):
+        """Read the current state of all axes and buttons, used when opening
+        and when the kernel has dropped events"""
+        for (code, (i, axis)) in self._axes.items():
+            self.axes[i] = axis.value(self._absinfo(code)[0])
+        pressed = bytearray((KEY_MAX + 8) // 8)
+        fcntl.ioctl(self._fd, EVIOCGKEY, pressed)
+        pressed = set(_bits(pressed))
+        for (code, i) in self._buttons.items():
+            self.buttons[i] = 1 if code in pressed else 0
+
+    def _read_all_events(self):
+        """Consume all the events queued up in the device"""
+        axes = self.axes
+        buttons = self.buttons
+        axis_map = self._axes
+        button_map = self._buttons
+        size = EV_EVENT.size * EV_READ_EVENTS
+        event_time = None
+        try:
+            while True:
+                data = os.read(self._fd, size)
+                for (sec, usec, evt_type, code, value) in \
+                        EV_EVENT.iter_unpack(data):
+                    if self._dropping:
+                        # The events up to the next report are incomplete,
+                        # the state is read from the device after it
+                        if evt_type == EV_SYN and code == SYN_REPORT:
+                            self._dropping = False
+                            self._sync()
+                        continue
+                    if evt_type == EV_ABS:
+                        if code in axis_map:
+                            (i, axis) = axis_map[code]
+                            axes[i] = axis.value(value)
+                    elif evt_type == EV_KEY:
+                        if code in button_map:
+                            buttons[button_map[code]] = 1 if value else 0
+                    elif evt_type == EV_SYN:
+                        if code == SYN_DROPPED:
+                            self._dropping = True
+                        continue
+                    else:
+                        continue
+                    event_time = sec + usec * 1e-6
+                if len(data) < size:
+                    break
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            logger.info(str(e))
+            self.close()
+            raise IOError("Device has been disconnected")
+        if event_time is not None:
+            self.event_time = event_time + self._time_offset
+
+    def read(self):
+        """ Returns a list of all joystick event since the last call """
+        if self._fd is None:
+            raise Exception("Joystick device not opened")
+
+        self._read_all_events()
+
+        return [self.axes, self.buttons]
+
+
+class EvdevReader():
+    """
+    Linux evdev implementation of the Joystick class
+    """
+
+    def __init__(self):
+        self.name = MODULE_NAME
+        self._devs = {}
+        self._devices = []
+
+    def devices(self):
+        """
+        Returns a list of the detected joysticks as dicts with id and name
+        (result is cached once one or more device are found)
+        """
+
+        if len(self._devices) == 0:
+            for path in glob.glob("/sys/class/input/event*"):
+                if not _is_joystick(path):
+                    continue
+                device_id = int(os.path.basename(path)[5:])
+                with open(path + "/device/name") as namefile:
+                    name = namefile.read().strip()
+                # Keep the device if it is still there after a rescan
+                old = self._devs.get(device_id)
+                if not old or old.name != name:
+                    if old:
+                        old.close()
+                    self._devs[device_id] = _Evdev(device_id, name)
+                self._devices.append({"id": device_id, "name": name})
+
+        return self._devices
+
+    def rescan(self):
+        """Look for devices again at the next call to devices()"""
+        self._devices = []
+
+    def open(self, device_id):
+        """
+        Open the device. The device_id is given by devices()
+        """
+        self._devs[device_id].open()
+
+    def close(self, device_id):
+        """Close the device"""
+        self._devs[device_id].close()
+
+    def read(self, device_id):
+        """ Returns a list of all joystick event since the last call """
+        return self._devs[device_id].read()
+
+    def fileno(self, device_id):
+        """Return the file descriptor that is readable when the device has
+        new events, or None if it is not opened"""
+        return self._devs[device_id].fileno()
+
+    def event_time(self, device_id):
+        """Return the monotonic time the kernel got the newest event read
+        from the device, or None"""
+        return self._devs[device_id].event_time
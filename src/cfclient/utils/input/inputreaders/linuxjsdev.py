@@ -43,12 +43,20 @@ try:
 except ImportError as e:
     raise Exception("fcntl library probably not installed ({})".format(e))
 
+from cfclient.utils.config import Config
+
+if Config().get("enable_evdev_input"):
+    raise Exception("Using the evdev reader (linuxevdev) instead")
+
 __author__ = 'Bitcraze AB'
 __all__ = ['Joystick']
 
 logger = logging.getLogger(__name__)
 
 JS_EVENT_FMT = "@IhBB"
+JS_EVENT = struct.Struct(JS_EVENT_FMT)
+# Number of events read from the device at a time
+JS_READ_EVENTS = 256
 JE_TIME = 0
 JE_VALUE = 1
 JE_TYPE = 2
@@ -104,7 +112,8 @@ class _JS():
             raise Exception("{} at {} is already "
                             "opened".format(self.name, self._f_name))
 
-        self._f = open("/dev/input/js{}".format(self.num), "rb")
+        # Not buffered, all reads are done with os.read on the descriptor
+        self._f = open("/dev/input/js{}".format(self.num), "rb", buffering=0)
         fcntl.fcntl(self._f.fileno(), fcntl.F_SETFL, os.O_NONBLOCK)
 
         # Get number of axis and button
@@ -134,18 +143,9 @@ class _JS():
         self._f = None
 
     def __initvalues(self):
-        """Read the buttons and axes initial values from the js device"""
-        for _ in range(len(self.axes) + len(self.buttons)):
-            data = self._f.read(struct.calcsize(JS_EVENT_FMT))
-            jsdata = struct.unpack(JS_EVENT_FMT, data)
-            self.__updatestate(jsdata)
-
-    def __updatestate(self, jsdata):
-        """Update the internal absolute state of buttons and axes"""
-        if jsdata[JE_TYPE] & JS_EVENT_AXIS != 0:
-            self.axes[jsdata[JE_NUMBER]] = jsdata[JE_VALUE] / 32768.0
-        elif jsdata[JE_TYPE] & JS_EVENT_BUTTON != 0:
-            self.buttons[jsdata[JE_NUMBER]] = jsdata[JE_VALUE]
+        """Read the buttons and axes initial values from the js device, they
+        are queued as events when the device is opened"""
+        self._read_all_events()
 
     def __decode_event(self, jsdata):
         """ Decode a jsdev event into a dict """
@@ -161,11 +161,21 @@ class _JS():
 
     def _read_all_events(self):
         """Consume all the events queued up in the JS device"""
+        axes = self.axes
+        buttons = self.buttons
+        size = JS_EVENT.size * JS_READ_EVENTS
         try:
+            fd = self._f.fileno()
             while True:
-                data = self._f.read(struct.calcsize(JS_EVENT_FMT))
-                jsdata = struct.unpack(JS_EVENT_FMT, data)
-                self.__updatestate(jsdata)
+                # The device only returns whole events
+                data = os.read(fd, size)
+                for (_, value, evt_type, number) in JS_EVENT.iter_unpack(data):
+                    if evt_type & JS_EVENT_AXIS != 0:
+                        axes[number] = value / 32768.0
+                    elif evt_type & JS_EVENT_BUTTON != 0:
+                        buttons[number] = value
+                if len(data) < size:
+                    break
         except IOError as e:
             if e.errno != 11:
                 logger.info(str(e))
@@ -182,6 +192,12 @@ class _JS():
             # This is the workaround to make both cases work.
             pass
 
+    def fileno(self):
+        """Return the file descriptor of the opened device or None"""
+        if not self._f:
+            return None
+        return self._f.fileno()
+
     def read(self):
         """ Returns a list of all joystick event since the last call """
         if not self._f:
@@ -216,11 +232,20 @@ class Joystick():
                 device_id = int(os.path.basename(path)[2:])
                 with open(path + "/device/name") as namefile:
                     name = namefile.read().strip()
-                self._js[device_id] = _JS(device_id, name)
+                # Keep the device if it is still there after a rescan
+                old = self._js.get(device_id)
+                if not old or old.name != name:
+                    if old:
+                        old.close()
+                    self._js[device_id] = _JS(device_id, name)
                 self._devices.append({"id": device_id, "name": name})
 
         return self._devices
 
+    def rescan(self):
+        """Look for devices again at the next call to devices()"""
+        self._devices = []
+
     def open(self, device_id):
         """
         Open the joystick device. The device_id is given by available_devices
@@ -234,3 +259,8 @@ class Joystick():
     def read(self, device_id):
         """ Returns a list of all joystick event since the last call """
         return self._js[device_id].read()
+
+    def fileno(self, device_id):
+        """Return the file descriptor that is readable when the device has
+        new events, or None if it is not opened"""
+        return self._js[device_id].fileno()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#     ||          ____  _ __
+#  +------+      / __ )(_) /_______________ _____  ___
+#  | 0xBC |     / __  / / __/ ___/ ___/ __ `/_  / / _ \
+#  +------+    / /_/ / / /_/ /__/ /  / /_/ / / /_/  __/
+#   ||  ||    /_____/_/\__/\___/_/   \__,_/ /___/\___/
+#
+#  Copyright (C) 2014 Bitcraze AB
+#
+#  Crazyflie Nano Quadcopter Client
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+#  02110-1301, USA.
+"""
+Recording of the raw axes and buttons read from input devices, and a reader
+that plays a recording back.
+
+A recording starts with RECORDING_MAGIC and the format version. Each frame
+is the time since the recording started in seconds and the axis and button
+counts (RECORDING_FRAME), then the axes as floats ("<f" each) and the
+buttons as bits, 8 buttons per byte with the first button in the lowest
+bit.
+
+Only devices giving raw axes and buttons (the input readers) are recorded,
+the input interfaces already give mapped values. The frames are written by
+a background thread, so reading the device never waits for the disk.
+"""
+import logging
+import queue
+import struct
+import time
+from threading import Thread
+
+__author__ = 'Bitcraze AB'
+__all__ = ['InputRecorder', 'ReplayReader']
+
+logger = logging.getLogger(__name__)
+
+RECORDING_MAGIC = b"CFIR"
+RECORDING_VERSION = 1
+RECORDING_HEADER = struct.Struct("<4sB")
+RECORDING_FRAME = struct.Struct("<dBB")
+
+MODULE_NAME = "replay"
+
+
+def _pack_buttons(buttons):
+    bits = 0
+    for (i, b) in enumerate(buttons):
+        if b:
+            bits |= 1 << i
+    return bits.to_bytes((len(buttons) + 7) // 8, "little")
+
+
+def _unpack_buttons(data, count):
+    bits = int.from_bytes(data, "little")
+    return [bits >> i & 1 for i in range(count)]
+
+
+class InputRecorder:
+    """Records every raw frame read from device to filename, until
+    stopped"""
+
+    def __init__(self, device, filename):
+        if device is None or not hasattr(device, "recorder"):
+            raise ValueError("Cannot record {}, not an input "
+                             "device".format(device))
+        self._file = open(filename, "wb")
+        self._file.write(RECORDING_HEADER.pack(RECORDING_MAGIC,
+                                               RECORDING_VERSION))
+        self._start = time.monotonic()
+        self.frames = 0
+        self._queue = queue.Queue()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        self._device = device
+        device.recorder = self
+        logger.info("Recording {} to {}".format(device.name, filename))
+
+    def add(self, axes, buttons, timestamp=None):
+        """Queue a frame, called by the device when it has been read. The
+        time of the frame is now unless given in seconds since the start."""
+        if timestamp is None:
+            timestamp = time.monotonic() - self._start
+        # Copied, readers reuse their lists
+        self._queue.put((timestamp, tuple(axes), tuple(buttons)))
+        self.frames += 1
+
+    def stop(self):
+        """Stop recording, returns once all the frames are written"""
+        if self._device.recorder is self:
+            self._device.recorder = None
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        running = True
+        while running:
+            frames = [self._queue.get()]
+            # Write what has been queued in the meantime in one go
+            while frames[-1] is not None and not self._queue.empty():
+                frames.append(self._queue.get())
+            if frames[-1] is None:
+                running = False
+                frames.pop()
+            try:
+                self._file.write(b"".join([self._pack(*f) for f in frames]))
+                # Written as they come, in case the process is killed
+                self._file.flush()
+            except (struct.error, IOError) as e:
+                logger.warning("Could not record frame: {}".format(e))
+        self._file.close()
+
+    @staticmethod
+    def _pack(timestamp, axes, buttons):
+        return (RECORDING_FRAME.pack(timestamp, len(axes), len(buttons)) +
+                struct.pack("<{}f".format(len(axes)), *axes) +
+                _pack_buttons(buttons))
+
+
+class ReplayReader:
+    """Input reader giving the frames of a recording, one frame per read.
+    The time of the frame last read is in time, the recording has been
+    played to the end when finished is set."""
+
+    def __init__(self, filename):
+        self.name = MODULE_NAME
+        self._filename = filename
+        with open(filename, "rb") as f:
+            self._data = f.read()
+        (magic, version) = RECORDING_HEADER.unpack_from(self._data)
+        if magic != RECORDING_MAGIC or version != RECORDING_VERSION:
+            raise Exception("{} is not an input recording".format(filename))
+        self.rewind()
+
+    def rewind(self):
+        """Start from the first frame again"""
+        self._offset = RECORDING_HEADER.size
+        self.time = 0.0
+        self.finished = self._offset >= len(self._data)
+        self._frame = [[], []]
+
+    def next_time(self):
+        """Return the time of the next frame, None at the end"""
+        if self.finished:
+            return None
+        return RECORDING_FRAME.unpack_from(self._data, self._offset)[0]
+
+    def devices(self):
+        return [{"id": 0, "name": "Replay of {}".format(self._filename)}]
+
+    def open(self, device_id):
+        return
+
+    def close(self, device_id):
+        return
+
+    def read(self, device_id):
+        """Return the next frame, the last one again at the end"""
+        if self.finished:
+            return self._frame
+        (self.time, axis_count, button_count) = \
+            RECORDING_FRAME.unpack_from(self._data, self._offset)
+        offset = self._offset + RECORDING_FRAME.size
+        axes = list(struct.unpack_from("<{}f".format(axis_count), self._data,
+                                       offset))
+        offset += axis_count * 4
+        size = (button_count + 7) // 8
+        buttons = _unpack_buttons(self._data[offset:offset + size],
+                                  button_count)
+        self._offset = offset + size
+        self.finished = self._offset >= len(self._data)
+        self._frame = [axes, buttons]
+        return self._frame
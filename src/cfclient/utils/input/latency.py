@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#     ||          ____  _ __
+#  +------+      / __ )(_) /_______________ _____  ___
+#  | 0xBC |     / __  / / __/ ___/ ___/ __ `/_  / / _ \
+#  +------+    / /_/ / / /_/ /__/ /  / /_/ / / /_/  __/
+#   ||  ||    /_____/_/\__/\___/_/   \__,_/ /___/\___/
+#
+#  Copyright (C) 2014 Bitcraze AB
+#
+#  Crazyflie Nano Quadcopter Client
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+#  02110-1301, USA.
+"""
+Latency statistics of the input path, from an input event until the
+set-point has been handed to the Crazyflie.
+
+Every read of the input (JoystickReader.read_input) is split in stages,
+each one counted in a histogram:
+
+ * wait: from the newest device event until the read started, only for
+   devices that give the kernel event time (linuxevdev)
+ * device: reading the raw values from the devices
+ * mapping: mapping and limiting the values in the devices
+ * mux: mixing the values of the devices in the mux
+ * callback <name>[<n>]: each callback of the set-point callers
+ * send: the calls to the Crazyflie commander, see timed_send
+ * total: from the event (or the start of the read when the event time is
+   not known) until the set-point was sent
+"""
+import json
+import time
+
+from cfclient.utils.histogram import Histogram
+
+__author__ = 'Bitcraze AB'
+__all__ = ['InputLatency']
+
+
+class InputLatency:
+    """Collects the time spent in each stage of the input path. Reads are
+    timed from the input thread, the statistics can be read from any
+    thread."""
+
+    def __init__(self):
+        self._histograms = {}
+        # Start of the current read, None outside of reads
+        self._start = None
+        # Where the total latency of the current read is counted from
+        self._origin = None
+        self._last_event_time = None
+
+    def add(self, stage, value):
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            histogram = self._histograms.setdefault(stage, Histogram())
+        histogram.add(value)
+
+    def start_read(self):
+        self._start = time.monotonic()
+        self._origin = self._start
+
+    def devices_read(self, devices):
+        """Count the stages of reading devices, called when the mux has
+        returned the data"""
+        now = time.monotonic()
+        event_times = [d.event_time for d in devices
+                       if d.event_time is not None]
+        if event_times:
+            event_time = max(event_times)
+            # The event time is kept until the next event, only count it
+            # once
+            if (self._last_event_time is None or
+                    event_time > self._last_event_time):
+                self._last_event_time = event_time
+                self._origin = min(event_time, self._start)
+                self.add("wait", self._start - self._origin)
+        read_times = [d.read_time for d in devices
+                      if d.read_time is not None]
+        mapped_times = [d.mapped_time for d in devices
+                        if d.mapped_time is not None]
+        if read_times and mapped_times:
+            self.add("device", max(read_times) - self._start)
+            self.add("mapping", max(mapped_times) - max(read_times))
+            self.add("mux", now - max(mapped_times))
+
+    def end_read(self):
+        self._start = None
+        self._origin = None
+
+    def timed_send(self, send, *args):
+        """Call send with args and count how long it took, and how long it
+        has been since the input event when called while reading"""
+        start = time.monotonic()
+        send(*args)
+        end = time.monotonic()
+        self.add("send", end - start)
+        if self._origin is not None:
+            self.add("total", end - self._origin)
+
+    def reset(self):
+        for histogram in list(self._histograms.values()):
+            histogram.reset()
+
+    def stats(self):
+        """Return the histograms of all stages as a dict"""
+        return dict((stage, histogram.as_dict()) for (stage, histogram) in
+                    sorted(self._histograms.items()))
+
+    def summary(self):
+        """Return a short text about the total latency"""
+        total = self._histograms.get("total")
+        if not total or not total.count:
+            return "Input latency: no set-points sent"
+
+        def limit(p):
+            bound = total.percentile(p)
+            if bound is None:
+                return "above the highest bucket"
+            return "< {:g} ms".format(bound * 1000)
+
+        return "Input latency: p50 {}, p99 {}".format(limit(0.5),
+                                                      limit(0.99))
+
+    def dump(self, filename):
+        """Write the statistics to filename as JSON"""
+        with open(filename, "w") as f:
+            json.dump({"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "stages": self.stats()}, f, indent=2)
+            f.write("\n")
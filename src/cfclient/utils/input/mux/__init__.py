@@ -68,6 +68,19 @@ class InputMux(object):
         logger.info("Adding device {} to MUX {}".format(dev.name, self.name))
         self._open_new_device(dev, role)
 
+    def swap_devices(self, devs):
+        """Use the devices in devs ({role: device}, roles left out get no
+        device) without opening or closing any device. Returns the devices
+        used before in the same form, to swap them back."""
+        unknown = [role for role in devs if role not in self._devs]
+        if unknown:
+            raise Exception("MUX {} has no role {}".format(self.name,
+                                                           unknown[0]))
+        old_devs = dict(self._devs)
+        for role in self._devs:
+            self._devs[role] = devs.get(role)
+        return old_devs
+
     def pause(self):
         for d in [key for key in list(self._devs.keys()) if self._devs[key]]:
             self._devs[d].close()
@@ -79,6 +92,11 @@ class InputMux(object):
                 devs += (self._devs[d], )
         return devs
 
+    def filenos(self):
+        """Return the file descriptors of the devices that can wake up the
+        reading, devices without one are only polled"""
+        return [d.fileno() for d in self.devices()]
+
     def resume(self):
         for d in [key for key in list(self._devs.keys()) if self._devs[key]]:
             self._devs[d].open()
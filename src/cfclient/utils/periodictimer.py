@@ -28,59 +28,209 @@
 """
 Implementation of a periodic timer that will call a callback every time
 the timer expires once started.
+
+All the timers are run by one scheduler thread. Each timer has a priority
+class, when several timers are due the one with the highest priority
+(lowest value) is called first. A timer is also held back if its callback
+is expected to still be running when a timer with higher priority is due,
+but never for more than its own period. A callback that blocks delays all
+the other timers, so callbacks should return quickly.
 """
 
+import heapq
+import itertools
 import logging
+from threading import Condition
 from threading import Thread
 from cflib.utils.callbacks import Caller
 import time
 
+from cfclient.utils.histogram import Histogram
+from cfclient.utils.singleton import Singleton
+
 __author__ = 'Bitcraze AB'
-__all__ = ['PeriodicTimer']
+__all__ = ['PeriodicTimer', 'PRIORITY_CONTROL', 'PRIORITY_NORMAL',
+           'PRIORITY_HOUSEKEEPING']
 
 logger = logging.getLogger(__name__)
 
+# Priority classes of the timers
+PRIORITY_CONTROL = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HOUSEKEEPING = 2
+
+# Weight of the newest call when estimating how long a callback takes
+DURATION_WEIGHT = 0.25
+
 
 class PeriodicTimer:
-    """Create a periodic timer that will periodically call a callback"""
+    """Create a periodic timer that will periodically call a callback. The
+    callbacks are called on fixed deadlines, the time spent in the callbacks
+    does not delay the following calls. If the callbacks take longer than a
+    period the missed calls are skipped rather than made in a burst."""
 
-    def __init__(self, period, callback):
+    def __init__(self, period, callback, priority=PRIORITY_NORMAL):
         self._callbacks = Caller()
         self._callbacks.add_callback(callback)
         self._started = False
         self._period = period
-        self._thread = None
+        self._priority = priority
+        self._timer = None
+        self._stats = _TimerStats()
+
+    def stats(self):
+        """Return the timing statistics: the number of calls, skipped calls,
+        how late the calls were (jitter) and how much longer than a period
+        the callbacks took (overrun)"""
+        return self._stats.as_dict(self._period)
+
+    def reset_stats(self):
+        self._stats.reset()
 
     def start(self):
         """Start the timer"""
-        if self._thread:
+        if self._timer:
             logger.warning("Timer already started, not restarting")
             return
-        self._thread = _PeriodicTimerThread(self._period, self._callbacks)
-        self._thread.setDaemon(True)
-        self._thread.start()
+        self._timer = _Scheduler().add(self._period, self._priority,
+                                       self._callbacks, self._stats)
 
     def stop(self):
         """Stop the timer"""
-        if self._thread:
-            self._thread.stop()
-            self._thread = None
+        if self._timer:
+            _Scheduler().remove(self._timer)
+            self._timer = None
 
 
-class _PeriodicTimerThread(Thread):
+class _TimerStats():
 
-    def __init__(self, period, caller):
-        super(_PeriodicTimerThread, self).__init__()
-        self._period = period
-        self._callbacks = caller
-        self._stop = False
+    def __init__(self):
+        self.jitter = Histogram()
+        self.overrun = Histogram()
+        self.reset()
 
-    def stop(self):
-        self._stop = True
-
-    def run(self):
-        while not self._stop:
-            time.sleep(self._period)
-            if self._stop:
-                break
-            self._callbacks.call()
+    def reset(self):
+        self.calls = 0
+        self.skipped = 0
+        self.jitter.reset()
+        self.overrun.reset()
+
+    def as_dict(self, period):
+        return {"period": period, "calls": self.calls,
+                "skipped": self.skipped, "jitter": self.jitter.as_dict(),
+                "overrun": self.overrun.as_dict()}
+
+
+class _ScheduledTimer():
+    """A started timer, as kept by the scheduler"""
+
+    def __init__(self, period, priority, caller, stats):
+        self.period = period
+        self.priority = priority
+        self.callbacks = caller
+        self.stats = stats
+        self.deadline = time.monotonic() + period
+        self.active = True
+        # Estimated time spent in the callbacks
+        self.duration = 0.0
+
+    def call(self):
+        start = time.monotonic()
+        self.callbacks.call()
+        end = time.monotonic()
+        self.duration += (end - start - self.duration) * DURATION_WEIGHT
+
+        self.stats.calls += 1
+        self.stats.jitter.add(start - self.deadline)
+        if end - start > self.period:
+            self.stats.overrun.add(end - start - self.period)
+
+        self.deadline += self.period
+        if self.deadline <= end:
+            # Skip the calls we have missed instead of bursting
+            missed = int((end - self.deadline) / self.period) + 1
+            self.stats.skipped += missed
+            self.deadline += missed * self.period
+
+
+class _Scheduler(metaclass=Singleton):
+    """Calls the started timers from one thread. Timers wait for their
+    deadline in one heap, timers that are due are moved to another heap
+    ordered by priority."""
+
+    def __init__(self):
+        self._condition = Condition()
+        self._waiting = []
+        self._due = []
+        # Keeps the heaps stable for timers with equal keys
+        self._order = itertools.count()
+        self._thread = None
+
+    def add(self, period, priority, caller, stats):
+        timer = _ScheduledTimer(period, priority, caller, stats)
+        with self._condition:
+            self._wait(timer)
+            if not self._thread:
+                self._thread = Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+        return timer
+
+    def remove(self, timer):
+        # The timer is dropped from the heaps when it comes up
+        with self._condition:
+            timer.active = False
+
+    def _wait(self, timer):
+        heapq.heappush(self._waiting,
+                       (timer.deadline, next(self._order), timer))
+
+    def _next_due(self):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                while self._waiting and self._waiting[0][0] <= now:
+                    timer = heapq.heappop(self._waiting)[2]
+                    if timer.active:
+                        heapq.heappush(self._due, (timer.priority,
+                                                   timer.deadline,
+                                                   next(self._order), timer))
+                while self._due and not self._due[0][3].active:
+                    heapq.heappop(self._due)
+                timeout = None
+                if self._due:
+                    timer = self._due[0][3]
+                    blocker = self._first_before(timer.priority,
+                                                 now + timer.duration)
+                    if (blocker is None or
+                            now - timer.deadline >= timer.period):
+                        return heapq.heappop(self._due)[3]
+                    # Let the more important timer go first
+                    timeout = blocker - now
+                elif self._waiting:
+                    timeout = self._waiting[0][0] - now
+                self._condition.wait(timeout)
+
+    def _first_before(self, priority, time_limit):
+        """Return the first deadline before time_limit of the waiting timers
+        with higher priority, or None if there is none"""
+        deadlines = [deadline for (deadline, _, timer) in self._waiting
+                     if timer.active and timer.priority < priority and
+                     deadline < time_limit]
+        if deadlines:
+            return min(deadlines)
+        return None
+
+    def _run(self):
+        while True:
+            timer = self._next_due()
+            try:
+                timer.call()
+            except Exception:
+                # Same as when each timer had a thread, the timer stops
+                logger.exception("Error in timer callback, stopping timer")
+                timer.active = False
+            with self._condition:
+                if timer.active:
+                    self._wait(timer)
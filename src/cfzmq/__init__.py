@@ -33,14 +33,29 @@ import sys
 import os
 import logging
 import signal
+import json
 import zmq
 import queue
+import struct
+import time
 from threading import Thread
+from threading import Lock
 import cflib.crtp
 from cflib.crazyflie import Crazyflie
 from cflib.crazyflie.log import LogConfig
+from cflib.crazyflie.log import LogTocElement
+from cflib.crazyflie.mem import MemoryElement
+
+try:
+    from cflib.crazyflie.mem import Poly4D
+except ImportError:
+    # Trajectories need a cflib with the high-level commander
+    Poly4D = None
 
 import cfclient
+from cfclient.utils.periodictimer import PeriodicTimer
+from cfzmq.recording import RecordWriter
+from cfzmq.shmring import ShmRingWriter
 
 if os.name == 'posix':
     print('Disabling standard output for libraries!')
@@ -52,7 +67,7 @@ if os.name == 'posix':
 #   so it doesn't need a windowing system.
 os.environ["SDL_VIDEODRIVER"] = "dummy"
 
-# Main command socket for control (ping/pong)
+# Main command socket for control (router, requests can be pipelined)
 ZMQ_SRV_PORT = 2000
 # Log data socket (publish)
 ZMQ_LOG_PORT = 2001
@@ -69,20 +84,379 @@ PARAM_TIMEOUT = 2
 CONNECT_TIMEOUT = 5
 # Timeout before giving up adding/starting log config
 LOG_TIMEOUT = 10
+# Timeout before giving up uploading a trajectory
+TRAJECTORY_TIMEOUT = 10
+# Coefficients per axis in a trajectory piece (7th degree polynomials)
+TRAJECTORY_POLY_SIZE = 8
+
+# Encodings available for log data published on the log socket
+LOG_ENCODING_JSON = "json"
+LOG_ENCODING_BINARY = "binary"
+
+# First byte of every binary log data frame, never the start of a JSON message
+LOG_BINARY_MAGIC = 0xBC
+# Binary frame header: magic, log config id, timestamp and the low 16 bits
+# of the sequence number
+LOG_BINARY_HEADER = "<BHIH"
+# Log variable types and how they are packed in binary log data frames
+LOG_BINARY_TYPES = {
+    "uint8_t": ("B", "u1"),
+    "uint16_t": ("H", "<u2"),
+    "uint32_t": ("I", "<u4"),
+    "int8_t": ("b", "i1"),
+    "int16_t": ("h", "<i2"),
+    "int32_t": ("i", "<i4"),
+    "FP16": ("f", "<f4"),
+    "float": ("f", "<f4"),
+}
+
+# Reductions available for derived log streams
+LOG_REDUCE_LAST = "last"
+LOG_REDUCE_MEAN = "mean"
+LOG_REDUCE_MINMAX = "minmax"
+
+# How often batched log configs are checked for samples that are due
+LOG_BATCH_CHECK_PERIOD = 0.01
+
+# Time without new set-points before thrust is set to zero (conflating mode)
+CTRL_WATCHDOG_TIMEOUT = 0.5
 
 logger = logging.getLogger(__name__)
 
 
-class _SrvThread(Thread):
+class _BinaryLogEncoder():
+    """Packs log data from one log config into fixed size binary frames"""
+
+    def __init__(self, config_id, conf):
+        self._id = config_id
+        self._names = []
+        self._types = []
+        for v in conf.variables:
+            self._names.append(v.name)
+            self._types.append(LogTocElement.get_cstring_from_id(v.fetch_as))
+        self._struct = struct.Struct(LOG_BINARY_HEADER + "".join(
+            [LOG_BINARY_TYPES[t][0] for t in self._types]))
+        self._conf_name = conf.name
+
+    def schema(self):
+        """Return the schema needed by subscribers to decode the frames. The
+        format can be used with struct and the dtype with numpy."""
+        dtype = [["magic", "u1"], ["id", "<u2"], ["timestamp", "<u4"],
+                 ["seq", "<u2"]]
+        variables = []
+        for name, ctype in zip(self._names, self._types):
+            dtype.append([name, LOG_BINARY_TYPES[ctype][1]])
+            variables.append({"name": name, "type": ctype})
+        return {"version": 2, "name": self._conf_name, "event": "schema",
+                "encoding": LOG_ENCODING_BINARY, "id": self._id,
+                "format": self._struct.format, "size": self._struct.size,
+                "dtype": dtype, "variables": variables}
+
+    def encode(self, ts, data, seq=0):
+        return self._struct.pack(LOG_BINARY_MAGIC, self._id, ts,
+                                 seq & 0xFFFF,
+                                 *[data[name] for name in self._names])
+
+
+class _LogBatcher():
+    """Collects log samples from one log config until either the maximum
+    number of samples or the maximum age of the oldest sample is reached"""
+
+    def __init__(self, max_samples, max_age):
+        self._max_samples = max_samples
+        self._max_age = max_age
+        self._samples = []
+        self._first_time = 0
+
+    def add(self, ts, data):
+        """Add a sample, returns True if the batch should be sent"""
+        now = time.monotonic()
+        if not self._samples:
+            self._first_time = now
+        self._samples.append((ts, data))
+        return ((self._max_samples and
+                 len(self._samples) >= self._max_samples) or
+                self.expired(now))
+
+    def expired(self, now):
+        """Return True if the oldest sample has been kept for too long"""
+        return (len(self._samples) > 0 and self._max_age > 0 and
+                now - self._first_time >= self._max_age)
+
+    def take(self):
+        """Return all the collected samples and start a new batch"""
+        samples = self._samples
+        self._samples = []
+        return samples
+
+
+class _LogReducer():
+    """Reduces the samples of a log config to one sample per period. The
+    reduction is updated for every sample so nothing but the running result
+    is kept. Periods are measured using the log timestamps, a period is
+    complete when the next sample of the source would fall outside it."""
+
+    def __init__(self, reduce, period, source_period):
+        self._reduce = reduce
+        self._period = period
+        self._source_period = source_period
+        self._start = None
+        self._count = 0
+        self._values = {}
+
+    def add(self, ts, data):
+        """Add a sample, returns the reduced sample (timestamp, variables) when
+        a period has been completed, otherwise None"""
+        if self._start is None:
+            self._start = ts
+        self._count += 1
+        if self._reduce == LOG_REDUCE_LAST:
+            self._values = data
+        elif self._reduce == LOG_REDUCE_MEAN:
+            for name, value in data.items():
+                self._values[name] = self._values.get(name, 0) + value
+        else:
+            for name, value in data.items():
+                if name in self._values:
+                    (low, high) = self._values[name]
+                    self._values[name] = (min(low, value), max(high, value))
+                else:
+                    self._values[name] = (value, value)
+        if ts - self._start + self._source_period >= self._period:
+            return self.take(ts)
+        return None
+
+    def take(self, ts):
+        """Return the reduced sample and start a new period"""
+        if self._count == 0:
+            return None
+        if self._reduce == LOG_REDUCE_LAST:
+            variables = dict(self._values)
+        elif self._reduce == LOG_REDUCE_MEAN:
+            variables = {name: total / self._count
+                         for name, total in self._values.items()}
+        else:
+            variables = {}
+            for name, (low, high) in self._values.items():
+                variables[name + ".min"] = low
+                variables[name + ".max"] = high
+        result = (ts, self._count, variables)
+        self._start = None
+        self._count = 0
+        self._values = {}
+        return result
+
+
+class _LogStream():
+    """A stream derived from a log config, published under its own name"""
+
+    def __init__(self, name, source, reducer, variables=None):
+        self.name = name
+        self.source = source
+        self.reducer = reducer
+        self.variables = variables
+        self.last_ts = 0
+
+
+class _LogRecording():
+    """Records the log data of the selected log configs (all if no names are
+    given) to a file. Names can be log config names or, in swarm mode,
+    uri/name."""
 
-    def __init__(self, socket, log_socket, param_socket, conn_socket, cf,
-                 *args):
-        super(_SrvThread, self).__init__(*args)
+    def __init__(self, filename, names=None):
+        self.filename = filename
+        self._writer = RecordWriter(filename)
+        self._names = names
+        self._streams = {}
+        # Samples arrive from the cflib threads of all the Crazyflies
+        self._lock = Lock()
+        self._closed = False
+
+    def add(self, name, ts, data, conf):
+        if self._names is not None and (conf.name not in self._names and
+                                        name not in self._names):
+            return
+        with self._lock:
+            if self._closed:
+                return
+            if name not in self._streams:
+                names = [v.name for v in conf.variables]
+                variables = []
+                for v in conf.variables:
+                    ctype = LogTocElement.get_cstring_from_id(v.fetch_as)
+                    variables.append((v.name, ctype,
+                                      LOG_BINARY_TYPES[ctype][0]))
+                self._streams[name] = (self._writer.add_stream(name,
+                                                               variables),
+                                       names)
+            (stream_id, names) = self._streams[name]
+            self._writer.write(stream_id, ts, [data[n] for n in names])
+
+    def close(self):
+        """Stop recording, returns the number of samples written"""
+        with self._lock:
+            self._closed = True
+        self._writer.close()
+        return self._writer.samples
+
+
+class _Publisher():
+    """Publishes messages on an XPUB socket, optionally with a topic frame
+    before the message so subscribers can filter using SUBSCRIBE prefixes.
+    Topics are the log config name for log messages, the complete parameter
+    name (group.name) for param messages and the event for conn messages.
+    If a shared memory ring is given every frame is also written to it.
+
+    Every message gets a sequence number per topic ("seq" in JSON messages,
+    one per frame for binary log data) so subscribers can detect gaps (see
+    GapCounter). JSON messages and binary frames are counted separately, a
+    binary log config still publishes its started and stopped events as
+    JSON and subscribers tell the two apart (by name and by config id)
+    without knowing the schema. ZMQ drops messages for a subscriber that
+    has reached the high-water mark, the other subscribers still get them.
+    Only if the socket has XPUB_NODROP set are messages refused, they are
+    then counted as dropped and not sent to any subscriber."""
+
+    def __init__(self, socket, topics=False, ring=None):
         self._socket = socket
-        self._log_socket = log_socket
-        self._param_socket = param_socket
-        self._conn_socket = conn_socket
+        self._topics = topics
+        self._ring = ring
+        # Messages are published both from cflib and the server threads
+        self._lock = Lock()
+        self._seq = {}
+        self._frame_seq = {}
+        self._sent = 0
+        self._dropped = 0
+
+    def stats(self):
+        return {"sent": self._sent, "dropped": self._dropped}
+
+    @staticmethod
+    def _next_seq(counters, topic, count=1):
+        seq = counters.get(topic, 0)
+        counters[topic] = seq + count
+        return seq
+
+    def _send(self, topic, frames):
+        if self._ring:
+            for frame in frames:
+                self._ring.write(frame)
+        if self._topics:
+            frames = [topic.encode("UTF-8")] + frames
+        # Subscriptions are received on XPUB sockets, they are not used
+        while self._socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            self._socket.recv(zmq.NOBLOCK)
+        try:
+            self._socket.send_multipart(frames, zmq.NOBLOCK)
+            self._sent += 1
+        except zmq.Again:
+            self._dropped += 1
+
+    def send_json(self, topic, obj):
+        with self._lock:
+            obj["seq"] = self._next_seq(self._seq, topic)
+            self._send(topic, [json.dumps(obj).encode("UTF-8")])
+
+    def send_encoded(self, topic, encoder, samples):
+        """Send samples (timestamp, data) encoded by a binary log encoder as
+        one multipart message with one frame per sample"""
+        with self._lock:
+            seq = self._next_seq(self._frame_seq, topic, len(samples))
+            self._send(topic, [encoder.encode(ts, data, seq + i)
+                               for (i, (ts, data)) in enumerate(samples)])
+
+
+class GapCounter():
+    """Counts the messages a subscriber has missed, from the sequence
+    numbers of the messages it received. Only the low 16 bits are compared,
+    like in binary log frames, so a gap of 65536 messages or more is not
+    seen in full."""
+
+    def __init__(self):
+        self._next = {}
+        self.missed = 0
+
+    def add(self, topic, seq):
+        """Add a received message (or binary log frame), returns the number
+        of messages missed before it"""
+        expected = self._next.get(topic)
+        self._next[topic] = (seq + 1) & 0xFFFF
+        if expected is None:
+            return 0
+        missed = (seq - expected) & 0xFFFF
+        self.missed += missed
+        return missed
+
+
+class _PendingCommand():
+    """A command that will be answered once the Crazyflie has responded"""
+
+    def __init__(self, envelope, resp, timeout, timeout_status, timeout_msg,
+                 timeout_result=None):
+        self.envelope = envelope
+        self.resp = resp
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = time.monotonic() + timeout
+        self.timeout_status = timeout_status
+        self.timeout_msg = timeout_msg
+        # Called on timeout to get the partial result, if any
+        self.timeout_result = timeout_result
+
+
+class _ParamBatch():
+    """Keeps track of the confirmations for a batch of parameter writes"""
+
+    def __init__(self, key, names):
+        self.key = key
+        self._outstanding = set(names)
+        self._params = {}
+        self._lock = Lock()
+
+    def waits_for(self, name):
+        return name in self._outstanding
+
+    def outstanding(self):
+        with self._lock:
+            return list(self._outstanding)
+
+    def confirm(self, name, value):
+        with self._lock:
+            self._outstanding.discard(name)
+            self._params[name] = {"status": 0, "value": value}
+
+    def fail(self, name, status, msg):
+        with self._lock:
+            self._outstanding.discard(name)
+            self._params[name] = {"status": status, "msg": msg}
+
+    def done(self):
+        return len(self._outstanding) == 0
+
+    def result(self):
+        """Return the status of all the parameters, parameters that are not
+        yet confirmed are reported as timed out"""
+        with self._lock:
+            params = dict(self._params)
+            for name in self._outstanding:
+                params[name] = {"status": 3, "msg": "Timeout"}
+        status = 0
+        if any([p["status"] != 0 for p in params.values()]):
+            status = 3 if self._outstanding else 6
+        return {"status": status, "params": params}
+
+
+class _CrazyflieHandler():
+    """Handles the commands, log configs and parameters of one Crazyflie.
+    Commands are run in a worker thread so a Crazyflie that is slow to answer
+    does not hold up the server or the other Crazyflies, unless worker is
+    False in which case they are run by the caller. In swarm mode all the
+    published messages are tagged with the URI of the Crazyflie."""
+
+    def __init__(self, server, cf, uri=None, worker=True):
+        self._server = server
         self._cf = cf
+        self._uri = uri
 
         self._cf.connected.add_callback(self._connected)
         self._cf.connection_failed.add_callback(self._connection_failed)
@@ -92,70 +466,174 @@ class _SrvThread(Thread):
         self._cf.param.all_updated.add_callback(self._tocs_updated)
         self._cf.param.all_update_callback.add_callback(self._all_param_update)
 
-        self._conn_queue = queue.Queue(1)
-        self._param_queue = queue.Queue(1)
-        self._log_started_queue = queue.Queue(1)
-        self._log_added_queue = queue.Queue(1)
-
         self._logging_configs = {}
+        self._log_encoders = {}
+
+        self._log_batchers = {}
+        # Batches are filled from cflib and emptied by the batch timer
+        self._log_lock = Lock()
+
+        # Derived streams by name, fed from the log data callback
+        self._log_streams = {}
+        self._log_streams_lock = Lock()
+
+        self._param_batches = []
+        # Keys of the single parameter sets waiting for each name, oldest
+        # first, guarded by the same lock as the batches
+        self._param_waiting = {}
+        self._param_batches_lock = Lock()
+        self._next_param_batch = 0
+        self._next_param_set = 0
+
+        self._commands = None
+        if worker:
+            self._commands = queue.Queue()
+            worker = Thread(target=self._run_commands)
+            worker.daemon = True
+            worker.start()
+
+    @property
+    def cf(self):
+        return self._cf
+
+    def submit(self, envelope, cmd):
+        """Queue a command to be run in the worker thread, or run it now if
+        there is no worker"""
+        if self._commands:
+            self._commands.put((envelope, cmd))
+        else:
+            self._run_command(envelope, cmd)
+
+    def _run_commands(self):
+        while True:
+            (envelope, cmd) = self._commands.get()
+            self._run_command(envelope, cmd)
+
+    def _run_command(self, envelope, cmd):
+        try:
+            response = self._handle_command(envelope, cmd)
+        except Exception as e:
+            logger.warning("Error while handling {}: {}".format(cmd, e))
+            response = {"version": 1, "status": 0xFE, "msg": str(e)}
+        # Commands without a response yet are answered when they complete
+        if response is not None:
+            self._server.reply(envelope, response)
+
+    def _key(self, *parts):
+        """Key for commands waiting for this Crazyflie"""
+        return (self._uri,) + parts
+
+    def _topic(self, topic):
+        if self._uri:
+            return "{}/{}".format(self._uri, topic)
+        return topic
+
+    def _tag(self, msg):
+        if self._uri:
+            msg["uri"] = self._uri
+        return msg
 
     def _connection_requested(self, uri):
         conn_ev = {"version": 1, "event": "requested", "uri": uri}
-        self._conn_socket.send_json(conn_ev)
+        self._server.conn_pub.send_json(self._topic("requested"), conn_ev)
 
     def _connected(self, uri):
         conn_ev = {"version": 1, "event": "connected", "uri": uri}
-        self._conn_socket.send_json(conn_ev)
+        self._server.conn_pub.send_json(self._topic("connected"), conn_ev)
 
     def _connection_failed(self, uri, msg):
         logger.info("Connection failed to {}: {}".format(uri, msg))
-        resp = {"version": 1, "status": 1, "msg": msg}
-        self._conn_queue.put_nowait(resp)
+        self._server.complete(self._key("connect"), {"status": 1, "msg": msg})
         conn_ev = {"version": 1, "event": "failed", "uri": uri, "msg": msg}
-        self._conn_socket.send_json(conn_ev)
+        self._server.conn_pub.send_json(self._topic("failed"), conn_ev)
 
     def _connection_lost(self, uri, msg):
         conn_ev = {"version": 1, "event": "lost", "uri": uri, "msg": msg}
-        self._conn_socket.send_json(conn_ev)
+        self._server.conn_pub.send_json(self._topic("lost"), conn_ev)
 
     def _disconnected(self, uri):
         conn_ev = {"version": 1, "event": "disconnected", "uri": uri}
-        self._conn_socket.send_json(conn_ev)
+        self._server.conn_pub.send_json(self._topic("disconnected"), conn_ev)
 
-    def _tocs_updated(self):
-        # First do the log
-        log_toc = self._cf.log.toc.toc
+    @staticmethod
+    def _toc_groups(toc, groups):
+        """Iterate over the (group, name, element) of a TOC, optionally only
+        for the listed groups"""
+        for group in toc:
+            if groups is None or group in groups:
+                for name in toc[group]:
+                    yield (group, name, toc[group][name])
+
+    def _log_toc(self, groups=None, compact=False):
+        if compact:
+            return [["{}.{}".format(group, name), element.ctype]
+                    for (group, name, element) in
+                    self._toc_groups(self._cf.log.toc.toc, groups)]
         log = {}
-        for group in log_toc:
-            log[group] = {}
-            for name in log_toc[group]:
-                log[group][name] = {"type": log_toc[group][name].ctype}
-        # The the params
-        param_toc = self._cf.param.toc.toc
-        param = {}
-        for group in param_toc:
-            param[group] = {}
-            for name in param_toc[group]:
-                param[group][name] = {
-                    "type": param_toc[group][name].ctype,
-                    "access": "RW" if param_toc[group][
-                        name].access == 0 else "RO",
-                    "value": self._cf.param.values[group][name]}
-
-        resp = {"version": 1, "status": 0, "log": log, "param": param}
-        self._conn_queue.put_nowait(resp)
-
-    def _handle_scanning(self):
+        for (group, name, element) in self._toc_groups(self._cf.log.toc.toc,
+                                                       groups):
+            log.setdefault(group, {})[name] = {"type": element.ctype}
+        return log
+
+    def _param_toc(self, groups=None, compact=False):
+        param = [] if compact else {}
+        for (group, name, element) in self._toc_groups(
+                self._cf.param.toc.toc, groups):
+            access = "RW" if element.access == 0 else "RO"
+            value = self._cf.param.values[group][name]
+            if compact:
+                param.append(["{}.{}".format(group, name), element.ctype,
+                              access, value])
+            else:
+                param.setdefault(group, {})[name] = {
+                    "type": element.ctype, "access": access, "value": value}
+        return param
+
+    def _tocs_updated(self):
+        self._server.complete(self._key("connect"),
+                              {"status": 0, "log": self._log_toc(),
+                               "param": self._param_toc()})
+
+    def _handle_toc(self, data):
+        """Answer with the TOCs cflib got when connecting. If compact is set
+        the TOCs are lists of [name, type] for log and
+        [name, type, access, value] for params, otherwise they are the same as
+        in the connect response."""
         resp = {"version": 1}
-        interfaces = cflib.crtp.scan_interfaces()
-        resp["interfaces"] = []
-        for i in interfaces:
-            resp["interfaces"].append({"uri": i[0], "info": i[1]})
+        if not self._cf.log.toc:
+            resp["status"] = 1
+            resp["msg"] = "Not connected"
+            return resp
+        groups = data.get("groups")
+        compact = data.get("compact", False)
+        which = data.get("toc", "all")
+        if which in ("log", "all"):
+            resp["log"] = self._log_toc(groups, compact)
+        if which in ("param", "all"):
+            resp["param"] = self._param_toc(groups, compact)
+        resp["status"] = 0
         return resp
 
-    def _handle_connect(self, uri):
+    def _handle_param_snapshot(self, data):
+        """Answer with the parameter values cflib holds, as
+        {group: {name: value}} or {group.name: value} if compact is set"""
+        resp = {"version": 1, "status": 0, "params": {}}
+        groups = data.get("groups")
+        values = self._cf.param.values
+        for group in values:
+            if groups is None or group in groups:
+                if data.get("compact", False):
+                    for name in values[group]:
+                        resp["params"]["{}.{}".format(group, name)] = \
+                            values[group][name]
+                else:
+                    resp["params"][group] = dict(values[group])
+        return resp
+
+    def _handle_connect(self, envelope, uri):
+        self._server.wait_for(self._key("connect"), envelope, {"version": 1})
         self._cf.open_link(uri)
-        return self._conn_queue.get(block=True)
+        return None
 
     def _logging_started(self, conf, started):
         out = {"version": 1, "name": conf.name}
@@ -163,8 +641,11 @@ class _SrvThread(Thread):
             out["event"] = "started"
         else:
             out["event"] = "stopped"
-        self._log_socket.send_json(out)
-        self._log_started_queue.put_nowait(started)
+            self._flush_batch(conf.name)
+        self._server.log_pub.send_json(self._topic(conf.name), self._tag(out))
+        self._server.complete(
+            self._key("log_started" if started else "log_stopped",
+                      conf.name), {"status": 0})
 
     def _logging_added(self, conf, added):
         out = {"version": 1, "name": conf.name}
@@ -172,12 +653,39 @@ class _SrvThread(Thread):
             out["event"] = "created"
         else:
             out["event"] = "deleted"
-        self._log_socket.send_json(out)
-        self._log_added_queue.put_nowait(added)
+        self._server.log_pub.send_json(self._topic(conf.name), self._tag(out))
+        self._server.complete(
+            self._key("log_added" if added else "log_deleted", conf.name),
+            {"status": 0})
 
-    def _handle_logging(self, data):
+    def _wait_and_call(self, key, envelope, resp, timeout, timeout_status,
+                       timeout_msg, func):
+        """Park the command before calling func since the answer can arrive
+        before func returns. Errors from func answer the parked command."""
+        self._server.wait_for(key, envelope, resp, timeout, timeout_status,
+                              timeout_msg)
+        try:
+            func()
+        except AttributeError as e:
+            self._server.complete(key, {"status": 2, "msg": str(e)})
+
+    def _handle_logging(self, envelope, data):
         resp = {"version": 1}
         if data["action"] == "create":
+            encoding = data.get("encoding", LOG_ENCODING_JSON)
+            if encoding not in (LOG_ENCODING_JSON, LOG_ENCODING_BINARY):
+                resp["status"] = 4
+                resp["msg"] = "Unknown log encoding {}".format(encoding)
+                return resp
+            batcher = None
+            if "batch" in data:
+                max_samples = data["batch"].get("samples", 0)
+                max_age = data["batch"].get("period", 0) / 1000.0
+                if max_samples <= 0 and max_age <= 0:
+                    resp["status"] = 5
+                    resp["msg"] = "Batching needs samples and/or period"
+                    return resp
+                batcher = _LogBatcher(max_samples, max_age)
             lg = LogConfig(data["name"], data["period"])
             for v in data["variables"]:
                 lg.add_variable(v)
@@ -187,163 +695,957 @@ class _SrvThread(Thread):
                 lg.data_received_cb.add_callback(self._logdata_callback)
                 self._logging_configs[data["name"]] = lg
                 self._cf.log.add_config(lg)
-                lg.create()
-                self._log_added_queue.get(block=True, timeout=LOG_TIMEOUT)
-                resp["status"] = 0
+                self._log_encoders.pop(data["name"], None)
+                if encoding == LOG_ENCODING_BINARY:
+                    # The variable types are known once the config is added
+                    encoder = _BinaryLogEncoder(self._server.next_log_id(),
+                                                lg)
+                    self._log_encoders[data["name"]] = encoder
+                    resp["schema"] = self._tag(encoder.schema())
+                    self._server.log_pub.send_json(self._topic(data["name"]),
+                                                   resp["schema"])
+                self._log_batchers.pop(data["name"], None)
+                if batcher:
+                    self._log_batchers[data["name"]] = batcher
+                    self._server.start_batch_timer()
             except KeyError as e:
                 resp["status"] = 1
                 resp["msg"] = str(e)
+                return resp
             except AttributeError as e:
                 resp["status"] = 2
                 resp["msg"] = str(e)
-            except queue.Empty:
-                resp["status"] = 3
-                resp["msg"] = "Log configuration did not start"
-        if data["action"] == "start":
-            try:
-                self._logging_configs[data["name"]].start()
-                self._log_started_queue.get(block=True, timeout=LOG_TIMEOUT)
-                resp["status"] = 0
-            except KeyError as e:
+                return resp
+            self._wait_and_call(self._key("log_added", data["name"]),
+                                envelope, resp, LOG_TIMEOUT, 3,
+                                "Log configuration did not start", lg.create)
+            return None
+        if data["action"] in ("start", "stop", "delete"):
+            if data["name"] not in self._logging_configs:
                 resp["status"] = 1
-                resp["msg"] = "{} config not found".format(str(e))
-            except queue.Empty:
-                resp["status"] = 2
-                resp["msg"] = "Log configuration did not stop"
+                resp["msg"] = "'{}' config not found".format(data["name"])
+                return resp
+            lg = self._logging_configs[data["name"]]
+        if data["action"] == "start":
+            self._wait_and_call(self._key("log_started", data["name"]),
+                                envelope, resp, LOG_TIMEOUT, 2,
+                                "Log configuration did not start", lg.start)
+            return None
         if data["action"] == "stop":
-            try:
-                self._logging_configs[data["name"]].stop()
-                self._log_started_queue.get(block=True, timeout=LOG_TIMEOUT)
-                resp["status"] = 0
-            except KeyError as e:
-                resp["status"] = 1
-                resp["msg"] = "{} config not found".format(str(e))
-            except queue.Empty:
-                resp["status"] = 2
-                resp["msg"] = "Log configuration did not stop"
+            self._wait_and_call(self._key("log_stopped", data["name"]),
+                                envelope, resp, LOG_TIMEOUT, 2,
+                                "Log configuration did not stop", lg.stop)
+            return None
         if data["action"] == "delete":
-            try:
-                self._logging_configs[data["name"]].delete()
-                self._log_added_queue.get(block=True, timeout=LOG_TIMEOUT)
-                resp["status"] = 0
-            except KeyError as e:
-                resp["status"] = 1
-                resp["msg"] = "{} config not found".format(str(e))
-            except queue.Empty:
-                resp["status"] = 2
-                resp["msg"] = "Log configuration did not stop"
+            self._flush_batch(data["name"])
+            for stream in list(self._log_streams.values()):
+                if stream.source == data["name"]:
+                    self._delete_stream(stream.name)
+            self._log_encoders.pop(data["name"], None)
+            self._log_batchers.pop(data["name"], None)
+            self._wait_and_call(self._key("log_deleted", data["name"]),
+                                envelope, resp, LOG_TIMEOUT, 2,
+                                "Log configuration was not deleted",
+                                lg.delete)
+            return None
 
         return resp
 
-    def _handle_param(self, data):
+    def _handle_stream(self, data):
+        """Create or delete a stream derived from a log config. The stream
+        publishes one sample per period, reduced with the last value, the
+        mean or the minimum and maximum (as name.min and name.max) of the
+        samples in the period, for all or the listed variables of the
+        source."""
         resp = {"version": 1}
-        group = data["name"].split(".")[0]
-        name = data["name"].split(".")[1]
-        self._cf.param.add_update_callback(group=group, name=name,
-                                           cb=self._param_callback)
-        try:
-            self._cf.param.set_value(data["name"], str(data["value"]))
-            answer = self._param_queue.get(block=True, timeout=PARAM_TIMEOUT)
-            resp["name"] = answer["name"]
-            resp["value"] = answer["value"]
+        if data["action"] == "create":
+            if data["source"] not in self._logging_configs:
+                resp["status"] = 1
+                resp["msg"] = "'{}' config not found".format(data["source"])
+                return resp
+            source = self._logging_configs[data["source"]]
+            reduce = data.get("reduce", LOG_REDUCE_LAST)
+            period = data.get("period")
+            variables = data.get("variables")
+            known = [v.name for v in source.variables]
+            resp["status"] = 4
+            if reduce not in (LOG_REDUCE_LAST, LOG_REDUCE_MEAN,
+                              LOG_REDUCE_MINMAX):
+                resp["msg"] = "Unknown reduction {}".format(reduce)
+                return resp
+            if (isinstance(period, bool) or
+                    not isinstance(period, (int, float)) or period <= 0):
+                resp["msg"] = "Period must be a positive number of ms"
+                return resp
+            if variables is not None and (
+                    not isinstance(variables, list) or
+                    not all(v in known for v in variables)):
+                resp["msg"] = "Variables must be a list of variables " \
+                              "in '{}'".format(data["source"])
+                return resp
+            if data["name"] in self._logging_configs:
+                resp["status"] = 5
+                resp["msg"] = "'{}' is a log config".format(data["name"])
+                return resp
+            stream = _LogStream(data["name"], data["source"],
+                                _LogReducer(reduce, period,
+                                            source.period_in_ms),
+                                variables)
+            with self._log_streams_lock:
+                self._log_streams[data["name"]] = stream
+            self._server.log_pub.send_json(
+                self._topic(data["name"]),
+                self._tag({"version": 1, "name": data["name"],
+                           "event": "created", "source": data["source"],
+                           "reduce": reduce, "period": period,
+                           "variables": variables or known}))
+            resp["status"] = 0
+            return resp
+        if data["action"] == "delete":
+            if data["name"] not in self._log_streams:
+                resp["status"] = 1
+                resp["msg"] = "'{}' stream not found".format(data["name"])
+                return resp
+            self._delete_stream(data["name"])
             resp["status"] = 0
-        except KeyError as e:
+            return resp
+        resp["status"] = 0xFF
+        resp["msg"] = "Unknown action {}".format(data["action"])
+        return resp
+
+    def _delete_stream(self, name):
+        """Publish what is left of the current period and remove the stream"""
+        with self._log_streams_lock:
+            stream = self._log_streams.pop(name, None)
+        if stream:
+            self._send_stream(stream, stream.reducer.take(stream.last_ts))
+            self._server.log_pub.send_json(
+                self._topic(name),
+                self._tag({"version": 1, "name": name, "event": "deleted"}))
+
+    def _send_stream(self, stream, sample):
+        if sample is None:
+            return
+        (ts, count, variables) = sample
+        out = {"version": 1, "name": stream.name, "event": "data",
+               "timestamp": ts, "samples": count, "variables": variables}
+        self._server.log_pub.send_json(self._topic(stream.name),
+                                       self._tag(out))
+
+    def _feed_streams(self, ts, data, conf):
+        with self._log_streams_lock:
+            for stream in self._log_streams.values():
+                if stream.source != conf.name:
+                    continue
+                if stream.variables is not None:
+                    sample = {v: data[v] for v in stream.variables}
+                else:
+                    sample = data
+                try:
+                    stream.last_ts = ts
+                    self._send_stream(stream, stream.reducer.add(ts, sample))
+                except Exception as e:
+                    # A broken stream must not stop its source publishing
+                    logger.warning("Could not feed stream {}: {}".format(
+                        stream.name, e))
+
+    def _handle_trajectory(self, envelope, data):
+        """Upload a trajectory to the trajectory memory and fly it using the
+        high-level commander. A trajectory is a list of pieces, each with a
+        duration (s) and TRAJECTORY_POLY_SIZE coefficients for x, y, z and
+        yaw. An upload replaces the trajectory uploaded before."""
+        resp = {"version": 1}
+        if Poly4D is None:
+            resp["status"] = 2
+            resp["msg"] = "Trajectories are not supported by this cflib"
+            return resp
+        if not self._cf.is_connected():
+            # The packets would be dropped without any error
             resp["status"] = 1
-            resp["msg"] = str(e)
+            resp["msg"] = "Not connected"
+            return resp
+        trajectory_id = data.get("trajectory_id", 1)
+        try:
+            commander = self._cf.high_level_commander
+            if data["action"] == "upload":
+                return self._upload_trajectory(envelope, trajectory_id,
+                                               data["pieces"])
+            elif data["action"] == "takeoff":
+                commander.takeoff(data["height"], data["duration"])
+            elif data["action"] == "start":
+                commander.start_trajectory(
+                    trajectory_id, time_scale=data.get("time_scale", 1.0),
+                    relative_position=data.get("relative", False),
+                    relative_yaw=data.get("relative_yaw", False),
+                    reversed=data.get("reversed", False))
+            elif data["action"] == "stop":
+                commander.stop()
+            elif data["action"] == "land":
+                commander.land(data.get("height", 0.0), data["duration"])
+            else:
+                resp["status"] = 0xFF
+                resp["msg"] = "Unknown action {}".format(data["action"])
+                return resp
         except AttributeError as e:
             resp["status"] = 2
             resp["msg"] = str(e)
-        except queue.Empty:
-            resp["status"] = 3
-            resp["msg"] = "Timeout when setting parameter" \
-                          "{}".format(data["name"])
+            return resp
+        resp["status"] = 0
+        return resp
+
+    def _upload_trajectory(self, envelope, trajectory_id, pieces):
+        resp = {"version": 1}
+        mems = self._cf.mem.get_mems(MemoryElement.TYPE_TRAJ)
+        if not mems:
+            resp["status"] = 1
+            resp["msg"] = "No trajectory memory"
+            return resp
+        trajectory = []
+        for piece in pieces:
+            axes = [piece[axis] for axis in ("x", "y", "z", "yaw")]
+            if any([len(c) != TRAJECTORY_POLY_SIZE for c in axes]):
+                resp["status"] = 4
+                resp["msg"] = "Each axis needs {} coefficients".format(
+                    TRAJECTORY_POLY_SIZE)
+                return resp
+            trajectory.append(Poly4D(piece["duration"],
+                                     *[Poly4D.Poly(c) for c in axes]))
+        mems[0].trajectory = trajectory
+        resp["pieces"] = len(trajectory)
+        self._wait_and_call(
+            self._key("trajectory"), envelope, resp, TRAJECTORY_TIMEOUT, 3,
+            "Timeout when uploading trajectory",
+            lambda: mems[0].write_data(
+                lambda mem, addr: self._trajectory_written(trajectory_id,
+                                                           len(trajectory)),
+                write_failed_cb=self._trajectory_write_failed))
+        return None
+
+    def _trajectory_write_failed(self, mem, addr):
+        self._server.complete(self._key("trajectory"), {
+            "status": 1,
+            "msg": "Writing the trajectory failed at {}".format(addr)})
+
+    def _trajectory_written(self, trajectory_id, n_pieces):
+        self._cf.high_level_commander.define_trajectory(trajectory_id, 0,
+                                                        n_pieces)
+        self._server.complete(self._key("trajectory"), {"status": 0})
+
+    def _handle_param(self, envelope, data):
+        action = data.get("action")
+        if action == "set":
+            return self._handle_param_set(envelope, data["params"])
+        if action == "get":
+            return self._handle_param_get(data["names"])
+        resp = {"version": 1}
+        name = data["name"]
+        parts = name.split(".")
+        if len(parts) != 2:
+            resp["status"] = 1
+            resp["msg"] = "{} is not a parameter name".format(name)
+            return resp
+        # Sets of the same parameter are confirmed in the order they were
+        # made, each set waits on its own key
+        key = self._key("param", name, self._next_param_set)
+        self._next_param_set += 1
+        with self._param_batches_lock:
+            self._param_waiting.setdefault(name, []).append(key)
+        self._cf.param.add_update_callback(group=parts[0], name=parts[1],
+                                           cb=self._param_callback)
+        self._server.wait_for(key, envelope, resp, PARAM_TIMEOUT, 3,
+                              "Timeout when setting parameter "
+                              "{}".format(name),
+                              lambda: self._param_set_timeout(name, key))
+        try:
+            self._cf.param.set_value(name, str(data["value"]))
+        except (KeyError, AttributeError) as e:
+            self._param_set_timeout(name, key)
+            self._server.complete(key, {
+                "status": 1 if isinstance(e, KeyError) else 2,
+                "msg": str(e)})
+        return None
+
+    def _param_set_timeout(self, name, key):
+        """Stop waiting for the confirmation of a single parameter set"""
+        with self._param_batches_lock:
+            keys = self._param_waiting.get(name, [])
+            if key in keys:
+                keys.remove(key)
+            if not keys:
+                self._param_waiting.pop(name, None)
+        self._release_param_callback(name)
+        return {}
+
+    def _handle_param_set(self, envelope, params):
+        """Write all the parameters at once and answer when all of them have
+        been confirmed, with the status of each parameter"""
+        resp = {"version": 1}
+        batch = _ParamBatch(self._key("param_set", self._next_param_batch),
+                            params.keys())
+        self._next_param_batch += 1
+        valid = []
+        for name in params:
+            parts = name.split(".")
+            if len(parts) != 2:
+                batch.fail(name, 1, "{} is not a parameter name".format(name))
+                continue
+            self._cf.param.add_update_callback(group=parts[0], name=parts[1],
+                                               cb=self._param_callback)
+            valid.append(name)
+        with self._param_batches_lock:
+            self._param_batches.append(batch)
+        self._server.wait_for(batch.key, envelope, resp, PARAM_TIMEOUT, 3,
+                              "Timeout when setting parameters",
+                              lambda: self._param_batch_timeout(batch))
+        for name in valid:
+            try:
+                self._cf.param.set_value(name, str(params[name]))
+            except (KeyError, AttributeError) as e:
+                batch.fail(name, 1 if isinstance(e, KeyError) else 2, str(e))
+                self._release_param_callback(name)
+        self._complete_param_batches()
+        return None
+
+    def _release_param_callback(self, name):
+        """Remove the update callback of name unless a set still waits for
+        it"""
+        with self._param_batches_lock:
+            if name in self._param_waiting or \
+                    any([b.waits_for(name) for b in self._param_batches]):
+                return
+        [group, name_short] = name.split(".")
+        self._cf.param.remove_update_callback(group=group, name=name_short,
+                                              cb=self._param_callback)
+
+    def _complete_param_batches(self):
+        with self._param_batches_lock:
+            done = [b for b in self._param_batches if b.done()]
+            for batch in done:
+                self._param_batches.remove(batch)
+        for batch in done:
+            self._server.complete(batch.key, batch.result())
+
+    def _param_batch_timeout(self, batch):
+        with self._param_batches_lock:
+            if batch in self._param_batches:
+                self._param_batches.remove(batch)
+        for name in batch.outstanding():
+            self._release_param_callback(name)
+        return batch.result()
+
+    def _handle_param_get(self, names):
+        """Answer with the values cached by cflib, without asking the
+        Crazyflie"""
+        resp = {"version": 1, "status": 0, "params": {}}
+        for name in names:
+            try:
+                [group, name_short] = name.split(".")
+                value = self._cf.param.values[group][name_short]
+                resp["params"][name] = {"status": 0, "value": value}
+            except (KeyError, ValueError):
+                resp["params"][name] = {"status": 1,
+                                        "msg": "{} not found".format(name)}
+                resp["status"] = 6
         return resp
 
     def _all_param_update(self, name, value):
         resp = {"version": 1, "name": name, "value": value}
-        self._param_socket.send_json(resp)
+        self._server.param_pub.send_json(self._topic(name), self._tag(resp))
 
     def _param_callback(self, name, value):
-        group = name.split(".")[0]
-        name_short = name.split(".")[1]
-        self._cf.param.remove_update_callback(group=group, name=name_short)
-        self._param_queue.put_nowait({"name": name, "value": value})
+        with self._param_batches_lock:
+            keys = self._param_waiting.get(name, [])
+            # The oldest set is the one confirmed
+            key = keys.pop(0) if keys else None
+            if not keys:
+                self._param_waiting.pop(name, None)
+            batches = list(self._param_batches)
+        if key:
+            self._server.complete(key, {"name": name, "value": value,
+                                        "status": 0})
+        for batch in batches:
+            if batch.waits_for(name):
+                batch.confirm(name, value)
+        self._complete_param_batches()
+        self._release_param_callback(name)
 
     def _logdata_callback(self, ts, data, conf):
+        recording = self._server.recording
+        if recording:
+            recording.add(self._topic(conf.name), ts, data, conf)
+        if self._log_streams:
+            self._feed_streams(ts, data, conf)
+        batcher = self._log_batchers.get(conf.name)
+        if batcher:
+            with self._log_lock:
+                if batcher.add(ts, data):
+                    self._send_batch(conf.name, batcher.take())
+            return
+        encoder = self._log_encoders.get(conf.name)
+        if encoder:
+            self._server.log_pub.send_encoded(self._topic(conf.name),
+                                              encoder, [(ts, data)])
+            return
         out = {"version": 1, "name": conf.name, "event": "data",
                "timestamp": ts, "variables": {}}
         for d in data:
             out["variables"][d] = data[d]
-        self._log_socket.send_json(out)
+        self._server.log_pub.send_json(self._topic(conf.name), self._tag(out))
+
+    def _send_batch(self, name, samples):
+        """Send a batch of samples, binary batches are sent as one multipart
+        message with one frame per sample"""
+        if not samples:
+            return
+        encoder = self._log_encoders.get(name)
+        if encoder:
+            self._server.log_pub.send_encoded(self._topic(name), encoder,
+                                              samples)
+            return
+        out = {"version": 1, "name": name, "event": "batch", "samples": []}
+        for (ts, data) in samples:
+            out["samples"].append({"timestamp": ts, "variables": data})
+        self._server.log_pub.send_json(self._topic(name), self._tag(out))
+
+    def _flush_batch(self, name):
+        batcher = self._log_batchers.get(name)
+        if batcher:
+            with self._log_lock:
+                self._send_batch(name, batcher.take())
+
+    def flush_expired_batches(self, now):
+        for name, batcher in list(self._log_batchers.items()):
+            with self._log_lock:
+                if batcher.expired(now):
+                    self._send_batch(name, batcher.take())
+
+    def _handle_command(self, envelope, cmd):
+        response = {"version": 1}
+        if cmd["cmd"] == "connect":
+            response = self._handle_connect(envelope, cmd["uri"])
+        elif cmd["cmd"] == "disconnect":
+            self._cf.close_link()
+            response["status"] = 0
+        elif cmd["cmd"] == "log":
+            response = self._handle_logging(envelope, cmd)
+        elif cmd["cmd"] == "param":
+            response = self._handle_param(envelope, cmd)
+        elif cmd["cmd"] == "stream":
+            response = self._handle_stream(cmd)
+        elif cmd["cmd"] == "trajectory":
+            response = self._handle_trajectory(envelope, cmd)
+        elif cmd["cmd"] == "toc":
+            response = self._handle_toc(cmd)
+        elif cmd["cmd"] == "param_snapshot":
+            response = self._handle_param_snapshot(cmd)
+        return response
+
+
+class _Server():
+    """Commands and state shared by the server cores. The Crazyflie handlers
+    use wait_for, complete and reply to answer commands, these and the
+    other methods raising NotImplementedError are implemented by the cores.
+
+    In swarm mode a Crazyflie is created for each URI that is connected and
+    all the commands for a Crazyflie must contain its "uri".
+
+    Log data can be recorded to a file in the server (record command) so
+    clients do not have to keep up with the log stream to save it."""
+
+    # Commands handled by the Crazyflie handlers
+    CF_COMMANDS = ("connect", "disconnect", "log", "param", "toc",
+                   "param_snapshot", "stream", "trajectory")
+
+    def __init__(self, log_pub, param_pub, conn_pub, cf_factory, swarm=False,
+                 worker=True):
+        self.log_pub = log_pub
+        self.param_pub = param_pub
+        self.conn_pub = conn_pub
+        self._cf_factory = cf_factory
+        self._swarm = swarm
+        # Run the commands of each Crazyflie in a worker thread
+        self._worker = worker
+
+        self._log_id_lock = Lock()
+        self._next_log_id = 0
+
+        self._batch_timer = PeriodicTimer(LOG_BATCH_CHECK_PERIOD,
+                                          self._flush_expired_batches)
+        self._batch_timer_started = False
+
+        self._handlers = {}
+        if not self._swarm:
+            self._handlers[None] = _CrazyflieHandler(self, cf_factory(),
+                                                     worker=worker)
+
+        self._stats = {}
+        self.add_stats("log", log_pub.stats)
+        self.add_stats("param", param_pub.stats)
+        self.add_stats("conn", conn_pub.stats)
+
+        # Read by the Crazyflie handlers for every log sample
+        self.recording = None
+
+    def add_stats(self, name, stats):
+        """Add a function returning counters answered by the stats
+        command"""
+        self._stats[name] = stats
+
+    def crazyflie(self, uri=None):
+        """Return the Crazyflie for uri (any uri if not in swarm mode) or None
+        if there is no such Crazyflie"""
+        handler = self._handlers.get(uri if self._swarm else None)
+        if handler:
+            return handler.cf
+        return None
+
+    def next_log_id(self):
+        """Return a new id for a binary log config, unique in the server"""
+        with self._log_id_lock:
+            log_id = self._next_log_id
+            self._next_log_id = (self._next_log_id + 1) & 0xFFFF
+        return log_id
+
+    def start_batch_timer(self):
+        if not self._batch_timer_started:
+            self._batch_timer_started = True
+            self._batch_timer.start()
+
+    def _flush_expired_batches(self):
+        now = time.monotonic()
+        for handler in list(self._handlers.values()):
+            handler.flush_expired_batches(now)
+
+    def _handle_record(self, cmd):
+        response = {"version": 1}
+        action = cmd.get("action")
+        if action == "start":
+            if not isinstance(cmd.get("file"), str):
+                response["status"] = 4
+                response["msg"] = "No file to record to"
+                return response
+            names = cmd.get("names")
+            if names is not None and (
+                    not isinstance(names, list) or
+                    not all(isinstance(n, str) for n in names)):
+                response["status"] = 4
+                response["msg"] = "Names must be a list of log config names"
+                return response
+            if self.recording:
+                response["status"] = 5
+                response["msg"] = "Already recording to {}".format(
+                    self.recording.filename)
+                return response
+            try:
+                self.recording = _LogRecording(cmd["file"], names)
+            except IOError as e:
+                response["status"] = 1
+                response["msg"] = str(e)
+                return response
+            response["status"] = 0
+        elif action == "stop":
+            if not self.recording:
+                response["status"] = 1
+                response["msg"] = "Not recording"
+                return response
+            recording = self.recording
+            self.recording = None
+            response["samples"] = recording.close()
+            response["file"] = recording.filename
+            response["status"] = 0
+        else:
+            response["status"] = 0xFF
+            response["msg"] = "Unknown action {}".format(action)
+        return response
+
+    def _get_handler(self, cmd):
+        if not self._swarm:
+            return self._handlers[None]
+        uri = cmd.get("uri")
+        if uri not in self._handlers and cmd["cmd"] == "connect" and uri:
+            self._handlers[uri] = _CrazyflieHandler(self, self._cf_factory(),
+                                                    uri, self._worker)
+        return self._handlers.get(uri)
+
+    def _handle_command(self, envelope, cmd):
+        """Handle a command, returns the response or None if the command will
+        be answered later"""
+        response = {"version": 1}
+        logger.info("Got command {}".format(cmd))
+        if cmd["cmd"] == "scan":
+            response = self._handle_scanning(envelope)
+        elif cmd["cmd"] == "stats":
+            for (name, stats) in self._stats.items():
+                response[name] = stats()
+            response["status"] = 0
+        elif cmd["cmd"] == "record":
+            response = self._handle_record(cmd)
+        elif cmd["cmd"] in _Server.CF_COMMANDS:
+            handler = self._get_handler(cmd)
+            if handler:
+                handler.submit(envelope, cmd)
+                response = None
+            else:
+                response["status"] = 0xFE
+                response["msg"] = "No Crazyflie with uri {}".format(
+                    cmd.get("uri"))
+        else:
+            response["status"] = 0xFF
+            response["msg"] = "Unknown command {}".format(cmd["cmd"])
+        return response
+
+    # Implemented by the cores
+
+    def wait_for(self, key, envelope, resp, timeout=None, timeout_status=0,
+                 timeout_msg=None, timeout_result=None):
+        """Park a command until complete is called with the same key, then
+        answer it with resp updated with the result. If timeout (s) passes
+        first it is answered with timeout_status and timeout_msg, updated
+        with what timeout_result returns if given. Can be called from any
+        thread."""
+        raise NotImplementedError()
+
+    def complete(self, key, result):
+        """Answer the commands waiting for key, can be called from any
+        thread"""
+        raise NotImplementedError()
+
+    def reply(self, envelope, resp):
+        """Send a response, can be called from any thread"""
+        raise NotImplementedError()
+
+    def _handle_scanning(self, envelope):
+        """Start a scan answered when done, returns the response if the
+        scan cannot be started"""
+        raise NotImplementedError()
+
+    def _send_response(self, envelope, resp):
+        """Send a response, only called from the core"""
+        raise NotImplementedError()
+
+    def _scan(self):
+        """Scan for Crazyflies, blocks for a long time"""
+        interfaces = cflib.crtp.scan_interfaces()
+        resp = {"interfaces": []}
+        for i in interfaces:
+            resp["interfaces"].append({"uri": i[0], "info": i[1]})
+        self.complete("scan", resp)
+
+    def _receive(self, frames):
+        # Everything up to the last frame is the routing envelope of the
+        # client (identity and, for REQ clients, the empty delimiter)
+        envelope = (frames[:-1], None)
+        try:
+            cmd = json.loads(frames[-1].decode("UTF-8"))
+            envelope = (frames[:-1], cmd.get("id"))
+            response = self._handle_command(envelope, cmd)
+        except Exception as e:
+            # Always answer, a REQ client would wait forever otherwise
+            logger.warning("Could not handle command: {}".format(e))
+            response = {"version": 1, "status": 0xFE, "msg": str(e)}
+        # Commands without a response yet are answered when they complete
+        if response is not None:
+            self._send_response(envelope, response)
+
+
+class _SrvThread(_Server, Thread):
+    """Serves commands on a ROUTER socket. Commands that need an answer from
+    the Crazyflie are parked until the answer arrives (or times out) so other
+    clients are served in the meantime. A client can add an "id" to a
+    command, it is returned in the response to match them up."""
+
+    def __init__(self, socket, log_pub, param_pub, conn_pub, cf_factory,
+                 swarm=False):
+        Thread.__init__(self)
+        self._socket = socket
+
+        # Answers arrive in other threads and are handed over to the server
+        # thread using an inproc socket, since ZMQ sockets are not thread safe
+        done_addr = "inproc://cfzmq-done-{}".format(id(self))
+        self._done_receiver = socket.context.socket(zmq.PULL)
+        self._done_receiver.bind(done_addr)
+        self._done_sender = socket.context.socket(zmq.PUSH)
+        self._done_sender.connect(done_addr)
+        self._done_lock = Lock()
+        self._done_queue = queue.Queue()
+        self._pending = {}
+
+        _Server.__init__(self, log_pub, param_pub, conn_pub, cf_factory,
+                         swarm)
+        self.add_stats("batch_timer", self._batch_timer.stats)
+
+    def wait_for(self, key, envelope, resp, timeout=None, timeout_status=0,
+                 timeout_msg=None, timeout_result=None):
+        """Park a command until complete is called with the same key, can be
+        called from any thread"""
+        self._hand_over(("wait", key, _PendingCommand(
+            envelope, resp, timeout, timeout_status, timeout_msg,
+            timeout_result)))
+
+    def complete(self, key, result):
+        """Answer the commands waiting for key, can be called from any
+        thread"""
+        self._hand_over(("done", key, result))
+
+    def reply(self, envelope, resp):
+        """Send a response, can be called from any thread"""
+        self._hand_over(("reply", envelope, resp))
+
+    def _hand_over(self, msg):
+        # The queue keeps the order, the socket only wakes up the server
+        with self._done_lock:
+            self._done_queue.put(msg)
+            self._done_sender.send(b"")
+
+    def _handle_done(self):
+        while self._done_receiver.poll(0):
+            self._done_receiver.recv()
+            (what, key, data) = self._done_queue.get_nowait()
+            if what == "wait":
+                self._pending.setdefault(key, []).append(data)
+            elif what == "done":
+                for pending in self._pending.pop(key, []):
+                    pending.resp.update(data)
+                    self._send_response(pending.envelope, pending.resp)
+            elif what == "reply":
+                self._send_response(key, data)
+
+    def _expire_pending(self):
+        now = time.monotonic()
+        for key in list(self._pending.keys()):
+            waiting = []
+            for pending in self._pending[key]:
+                if pending.deadline is not None and now >= pending.deadline:
+                    pending.resp["status"] = pending.timeout_status
+                    pending.resp["msg"] = pending.timeout_msg
+                    if pending.timeout_result:
+                        pending.resp.update(pending.timeout_result())
+                    self._send_response(pending.envelope, pending.resp)
+                else:
+                    waiting.append(pending)
+            if waiting:
+                self._pending[key] = waiting
+            else:
+                del self._pending[key]
+
+    def _next_timeout(self):
+        """Return the time in ms until the first pending command expires"""
+        deadlines = [p.deadline for waiting in self._pending.values()
+                     for p in waiting if p.deadline is not None]
+        if not deadlines:
+            return None
+        return max(0, (min(deadlines) - time.monotonic()) * 1000)
+
+    def _send_response(self, envelope, resp):
+        (frames, cmd_id) = envelope
+        if cmd_id is not None:
+            resp["id"] = cmd_id
+        self._socket.send_multipart(frames +
+                                    [json.dumps(resp).encode("UTF-8")])
+
+    def _handle_scanning(self, envelope):
+        # Scanning blocks for a long time, do it in the background and let
+        # all clients asking in the meantime share the result
+        if "scan" not in self._pending:
+            Thread(target=self._scan, daemon=True).start()
+        self._pending.setdefault("scan", []).append(
+            _PendingCommand(envelope, {"version": 1}, None, 0, None))
+        return None
 
     def run(self):
         logger.info("Starting server thread")
+        poller = zmq.Poller()
+        poller.register(self._socket, zmq.POLLIN)
+        poller.register(self._done_receiver, zmq.POLLIN)
         while True:
-            # Wait for the command
-            cmd = self._socket.recv_json()
-            response = {"version": 1}
-            logger.info("Got command {}".format(cmd))
-            if cmd["cmd"] == "scan":
-                response = self._handle_scanning()
-            elif cmd["cmd"] == "connect":
-                response = self._handle_connect(cmd["uri"])
-            elif cmd["cmd"] == "disconnect":
-                self._cf.close_link()
-                response["status"] = 0
-            elif cmd["cmd"] == "log":
-                response = self._handle_logging(cmd)
-            elif cmd["cmd"] == "param":
-                response = self._handle_param(cmd)
+            events = dict(poller.poll(self._next_timeout()))
+            if self._done_receiver in events:
+                self._handle_done()
+            if self._socket in events:
+                frames = self._socket.recv_multipart()
+                try:
+                    self._receive(frames)
+                except Exception as e:
+                    logger.warning("Could not handle command: {}".format(e))
+            self._expire_pending()
+
+
+class _Ctrl():
+    """Forwards control set-points to the Crazyflie. By default every
+    set-point is sent as soon as it arrives. If a period is given the
+    set-points are conflated: only the newest one is sent, once per period,
+    and thrust is set to zero if no new set-point has arrived within the
+    watchdog timeout."""
+
+    def __init__(self, crazyflie, period=None,
+                 watchdog=CTRL_WATCHDOG_TIMEOUT):
+        self._crazyflie = crazyflie
+        self._period = period
+        self._watchdog = watchdog
+
+        # Newest set-point (and when it arrived) for each URI
+        self._latest = {}
+
+        self._received = 0
+        self._sent = 0
+        self._dropped = 0
+        self._stale = 0
+
+    def stats(self):
+        return {"conflate": self._period is not None,
+                "received": self._received, "sent": self._sent,
+                "dropped": self._dropped, "stale": self._stale}
+
+    def _send(self, uri, roll, pitch, yaw, thrust):
+        cf = self._crazyflie(uri)
+        if cf:
+            cf.commander.send_setpoint(roll, pitch, yaw, thrust)
+            self._sent += 1
+
+    def _forward(self, cmd):
+        self._received += 1
+        self._send(cmd.get("uri"), cmd["roll"], cmd["pitch"], cmd["yaw"],
+                   cmd["thrust"])
+
+    def _conflate(self, cmd, now):
+        """Keep the set-point until the next period"""
+        self._received += 1
+        uri = cmd.get("uri")
+        if uri in self._latest and not self._latest[uri][2]:
+            self._dropped += 1
+        self._latest[uri] = [cmd, now, False]
+
+    def _send_latest(self):
+        now = time.monotonic()
+        for uri in list(self._latest.keys()):
+            [cmd, received, sent] = self._latest[uri]
+            if now - received > self._watchdog:
+                # Input has stopped, cut the thrust and wait for new input
+                logger.warning("No set-point for {:.2f}s, setting thrust "
+                               "to zero".format(now - received))
+                self._send(uri, 0, 0, 0, 0)
+                self._stale += 1
+                del self._latest[uri]
             else:
-                response["status"] = 0xFF
-                response["msg"] = "Unknown command {}".format(cmd["cmd"])
-            self._socket.send_json(response)
+                self._send(uri, cmd["roll"], cmd["pitch"], cmd["yaw"],
+                           cmd["thrust"])
+                self._latest[uri][2] = True
 
 
-class _CtrlThread(Thread):
+class _CtrlThread(_Ctrl, Thread):
+    """Receives control set-points on a PULL socket in a thread"""
 
-    def __init__(self, socket, cf, *args):
-        super(_CtrlThread, self).__init__(*args)
+    def __init__(self, socket, crazyflie, period=None,
+                 watchdog=CTRL_WATCHDOG_TIMEOUT):
+        Thread.__init__(self)
+        _Ctrl.__init__(self, crazyflie, period, watchdog)
         self._socket = socket
-        self._cf = cf
+
+    def _receive_all(self):
+        now = time.monotonic()
+        while True:
+            try:
+                cmd = self._socket.recv_json(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            self._conflate(cmd, now)
 
     def run(self):
+        if self._period is None:
+            while True:
+                self._forward(self._socket.recv_json())
+
+        next_send = time.monotonic()
         while True:
-            cmd = self._socket.recv_json()
-            self._cf.commander.send_setpoint(cmd["roll"], cmd["pitch"],
-                                             cmd["yaw"], cmd["thrust"])
+            timeout = max(0, next_send - time.monotonic())
+            if self._socket.poll(timeout * 1000):
+                self._receive_all()
+            now = time.monotonic()
+            if now >= next_send:
+                self._send_latest()
+                next_send += self._period
+                if next_send < now:
+                    # Skip the periods we have missed instead of bursting
+                    next_send = now + self._period
 
 
 class ZMQServer():
     """Crazyflie ZMQ server"""
 
-    def __init__(self, base_url):
-        """Start threads and bind ports"""
+    def __init__(self, base_url, topics=False, swarm=False, ctrl_rate=None,
+                 shm=None, hwm=None, cf_factory=None, nodrop=()):
+        """Start threads and bind ports. The base URL can be tcp:// or, if
+        all clients are on the same host, ipc:// (ipc:///tmp/cfzmq gives
+        ipc:///tmp/cfzmq:2000 and so on). If topics is set all published
+        messages are prefixed by a topic frame. In swarm mode one Crazyflie
+        is handled per connected URI and commands, control set-points and
+        published messages are tagged with the URI. If ctrl_rate (Hz) is set
+        only the newest control set-point is sent, at that rate. If shm is
+        a path the log messages are also written to a shared memory ring
+        there (see cfzmq.shmring). The send high-water mark of each socket
+        can be set by name (cmd, log, param, conn) in hwm. The publishing
+        sockets named in nodrop (log, param, conn) refuse messages when a
+        subscriber is at the high-water mark instead of dropping them for
+        that subscriber only, so one slow subscriber throttles all of them.
+        The Crazyflies are created by calling cf_factory, if set."""
         cflib.crtp.init_drivers(enable_debug_driver=True)
-        self._cf = Crazyflie(ro_cache=None,
-                             rw_cache=cfclient.config_path + "/cache")
 
         signal.signal(signal.SIGINT, signal.SIG_DFL)
 
         self._base_url = base_url
         self._context = zmq.Context()
+        self._hwm = hwm or {}
+        self._nodrop = nodrop
+
+        self._ring = None
+        if shm:
+            self._ring = ShmRingWriter(shm)
+            logger.info("Writing log messages to ring {}".format(shm))
 
-        cmd_srv = self._bind_zmq_socket(zmq.REP, "cmd", ZMQ_SRV_PORT)
-        log_srv = self._bind_zmq_socket(zmq.PUB, "log", ZMQ_LOG_PORT)
-        param_srv = self._bind_zmq_socket(zmq.PUB, "param", ZMQ_PARAM_PORT)
+        cmd_srv = self._bind_zmq_socket(zmq.ROUTER, "cmd", ZMQ_SRV_PORT)
+        log_srv = _Publisher(
+            self._bind_zmq_socket(zmq.XPUB, "log", ZMQ_LOG_PORT), topics,
+            self._ring)
+        param_srv = _Publisher(
+            self._bind_zmq_socket(zmq.XPUB, "param", ZMQ_PARAM_PORT), topics)
         ctrl_srv = self._bind_zmq_socket(zmq.PULL, "ctrl", ZMQ_CTRL_PORT)
-        conn_srv = self._bind_zmq_socket(zmq.PUB, "conn", ZMQ_CONN_PORT)
+        conn_srv = _Publisher(
+            self._bind_zmq_socket(zmq.XPUB, "conn", ZMQ_CONN_PORT), topics)
 
         self._scan_thread = _SrvThread(cmd_srv, log_srv, param_srv, conn_srv,
-                                       self._cf)
+                                       cf_factory or self._create_crazyflie,
+                                       swarm)
         self._scan_thread.start()
 
-        self._ctrl_thread = _CtrlThread(ctrl_srv, self._cf)
+        self._ctrl_thread = _CtrlThread(
+            ctrl_srv, self._scan_thread.crazyflie,
+            1.0 / ctrl_rate if ctrl_rate else None)
+        self._scan_thread.add_stats("ctrl", self._ctrl_thread.stats)
+        if self._ring:
+            self._scan_thread.add_stats("shm", self._ring_stats)
         self._ctrl_thread.start()
 
-    def _bind_zmq_socket(self, pattern, name, port):
-        srv = self._context.socket(pattern)
+    def _ring_stats(self):
+        return {"written": self._ring.written, "skipped": self._ring.skipped}
+
+    @staticmethod
+    def _create_crazyflie():
+        return Crazyflie(ro_cache=None,
+                         rw_cache=cfclient.config_path + "/cache")
+
+    def _bind_zmq_socket(self, pattern, name, port, context=None):
+        srv = (context or self._context).socket(pattern)
+        if name in self._hwm:
+            srv.setsockopt(zmq.SNDHWM, self._hwm[name])
+        if pattern == zmq.XPUB and name in self._nodrop:
+            # Refuse messages when any subscriber is full, they are counted
+            # as dropped instead of being dropped for that subscriber only
+            srv.setsockopt(zmq.XPUB_NODROP, 1)
         srv_addr = "{}:{}".format(self._base_url, port)
+        if srv_addr.startswith("ipc://"):
+            directory = os.path.dirname(srv_addr[len("ipc://"):])
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
         srv.bind(srv_addr)
         logger.info("Biding ZMQ {} server"
                     "at {}".format(name, srv_addr))
@@ -357,9 +1659,36 @@ def main():
     parser = argparse.ArgumentParser(prog="cfzmq")
     parser.add_argument("-u", "--url", action="store", dest="url", type=str,
                         default="tcp://127.0.0.1",
-                        help="URL where ZMQ will accept connections")
+                        help="URL where ZMQ will accept connections, "
+                             "tcp://address or ipc://path")
     parser.add_argument("-d", "--debug", action="store_true", dest="debug",
                         help="Enable debug output")
+    parser.add_argument("-t", "--topics", action="store_true", dest="topics",
+                        help="Prefix published messages with a topic frame")
+    parser.add_argument("-s", "--swarm", action="store_true", dest="swarm",
+                        help="Handle one Crazyflie per connected URI")
+    parser.add_argument("-r", "--ctrl-rate", action="store", dest="ctrl_rate",
+                        type=float, default=None,
+                        help="Only send the newest control set-point, at "
+                             "this rate (Hz)")
+    parser.add_argument("--hwm", action="append", dest="hwm", type=str,
+                        default=[], metavar="SOCKET=N",
+                        help="Send high-water mark for a socket (cmd, log, "
+                             "param or conn), can be repeated")
+    parser.add_argument("--nodrop", action="append", dest="nodrop", type=str,
+                        default=[], metavar="SOCKET",
+                        help="Refuse and count messages on a publishing "
+                             "socket (log, param or conn) when a subscriber "
+                             "is full, one slow subscriber then throttles "
+                             "all of them. Can be repeated")
+    parser.add_argument("-a", "--asyncio", action="store_true",
+                        dest="asyncio",
+                        help="Serve all sockets from one asyncio event loop")
+    parser.add_argument("--shm", action="store", dest="shm", type=str,
+                        default=None,
+                        help="Also write log messages to a shared memory "
+                             "ring at this path (for example "
+                             "/dev/shm/cfzmq-log)")
     (args, unused) = parser.parse_known_args()
 
     if args.debug:
@@ -367,7 +1696,22 @@ def main():
     else:
         logging.basicConfig(level=logging.INFO)
 
-    ZMQServer(args.url)
+    hwm = {}
+    for setting in args.hwm:
+        (name, value) = setting.split("=")
+        hwm[name] = int(value)
+
+    if args.asyncio:
+        import asyncio
+        from cfzmq.aioserver import AsyncZMQServer
+        server = AsyncZMQServer(args.url, topics=args.topics,
+                                swarm=args.swarm, ctrl_rate=args.ctrl_rate,
+                                shm=args.shm, hwm=hwm, nodrop=args.nodrop)
+        asyncio.run(server.run())
+    else:
+        ZMQServer(args.url, topics=args.topics, swarm=args.swarm,
+                  ctrl_rate=args.ctrl_rate, shm=args.shm, hwm=hwm,
+                  nodrop=args.nodrop)
 
     # CRTL-C to exit
 
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+#
+#     ||          ____  _ __
+#  +------+      / __ )(_) /_______________ _____  ___
+#  | 0xBC |     / __  / / __/ ___/ ___/ __ `/_  / / _ \
+#  +------+    / /_/ / / /_/ /__/ /  / /_/ / / /_/  __/
+#   ||  ||    /_____/_/\__/\___/_/   \__,_/ /___/\___/
+#
+#  Copyright (C) 2015 Bitcraze AB
+#
+#  Crazyflie Nano Quadcopter Client
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA  02110-1301, USA.
+
+"""
+Server core built on asyncio, used with cfzmq --asyncio.
+
+The command and control sockets are served from one event loop. Commands
+are handled in the loop instead of in a worker thread per Crazyflie, and a
+command waiting for the Crazyflie is a future that the cflib callback
+resolves. The cflib threads only hand results over to the loop. Since
+commands run in the loop, the cflib calls they make must not block (scanning
+is run in an executor for that reason).
+
+Messages are still published straight from the cflib threads since sending
+on a PUB socket never blocks, going through the loop would only add a hop.
+"""
+
+import asyncio
+import json
+import logging
+import signal
+import time
+
+import zmq
+import zmq.asyncio
+import cflib.crtp
+
+from cfzmq import ZMQServer
+from cfzmq import _Ctrl
+from cfzmq import _PendingCommand
+from cfzmq import _Publisher
+from cfzmq import _Server
+from cfzmq import CTRL_WATCHDOG_TIMEOUT
+from cfzmq import LOG_BATCH_CHECK_PERIOD
+from cfzmq import ZMQ_CONN_PORT
+from cfzmq import ZMQ_CTRL_PORT
+from cfzmq import ZMQ_LOG_PORT
+from cfzmq import ZMQ_PARAM_PORT
+from cfzmq import ZMQ_SRV_PORT
+from cfzmq.shmring import ShmRingWriter
+
+__author__ = 'Bitcraze AB'
+__all__ = ['AsyncZMQServer']
+
+logger = logging.getLogger(__name__)
+
+
+class _AsyncSrv(_Server):
+    """Serves commands on a ROUTER socket from the event loop"""
+
+    def __init__(self, loop, socket, log_pub, param_pub, conn_pub,
+                 cf_factory, swarm=False):
+        self._loop = loop
+        self._socket = socket
+        # Futures of the commands waiting for each key
+        self._pending = {}
+        # Keeps the tasks answering parked commands alive
+        self._tasks = set()
+        _Server.__init__(self, log_pub, param_pub, conn_pub, cf_factory,
+                         swarm, worker=False)
+
+    def _in_loop(self, func, *args):
+        """Call func in the event loop, directly if already in it"""
+        try:
+            if asyncio.get_running_loop() is self._loop:
+                func(*args)
+                return
+        except RuntimeError:
+            pass
+        self._loop.call_soon_threadsafe(func, *args)
+
+    def wait_for(self, key, envelope, resp, timeout=None, timeout_status=0,
+                 timeout_msg=None, timeout_result=None):
+        """Park a command until complete is called with the same key, can be
+        called from any thread"""
+        self._in_loop(self._park, key, _PendingCommand(
+            envelope, resp, timeout, timeout_status, timeout_msg,
+            timeout_result))
+
+    def complete(self, key, result):
+        """Answer the commands waiting for key, can be called from any
+        thread"""
+        self._in_loop(self._complete, key, result)
+
+    def reply(self, envelope, resp):
+        """Send a response, can be called from any thread"""
+        self._in_loop(self._send_response, envelope, resp)
+
+    def start_batch_timer(self):
+        if not self._batch_timer_started:
+            self._batch_timer_started = True
+            self._in_loop(self._start_task, self._flush_batches())
+
+    def _start_task(self, coro):
+        task = self._loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush_batches(self):
+        while True:
+            await asyncio.sleep(LOG_BATCH_CHECK_PERIOD)
+            self._flush_expired_batches()
+
+    def _park(self, key, pending):
+        future = self._loop.create_future()
+        self._pending.setdefault(key, []).append(future)
+        self._start_task(self._answer(key, future, pending))
+
+    def _complete(self, key, result):
+        for future in self._pending.pop(key, []):
+            if not future.done():
+                future.set_result(result)
+
+    async def _answer(self, key, future, pending):
+        timeout = None
+        if pending.deadline is not None:
+            timeout = max(0, pending.deadline - time.monotonic())
+        try:
+            pending.resp.update(await asyncio.wait_for(future, timeout))
+        except asyncio.TimeoutError:
+            waiting = self._pending.get(key, [])
+            if future in waiting:
+                waiting.remove(future)
+            if not waiting:
+                self._pending.pop(key, None)
+            pending.resp["status"] = pending.timeout_status
+            pending.resp["msg"] = pending.timeout_msg
+            if pending.timeout_result:
+                pending.resp.update(pending.timeout_result())
+        self._send_response(pending.envelope, pending.resp)
+
+    def _send_response(self, envelope, resp):
+        (frames, cmd_id) = envelope
+        if cmd_id is not None:
+            resp["id"] = cmd_id
+        # Sending on a ROUTER socket does not block, no need to wait for it
+        self._socket.send_multipart(frames +
+                                    [json.dumps(resp).encode("UTF-8")])
+
+    def _handle_scanning(self, envelope):
+        # Scanning blocks, let it run in the default executor and let all
+        # clients asking in the meantime share the result
+        if "scan" not in self._pending:
+            self._loop.run_in_executor(None, self._scan)
+        self._park("scan", _PendingCommand(envelope, {"version": 1}, None, 0,
+                                           None))
+        return None
+
+    async def serve(self):
+        logger.info("Starting asyncio server")
+        while True:
+            frames = await self._socket.recv_multipart()
+            try:
+                self._receive(frames)
+            except Exception as e:
+                logger.warning("Could not handle command: {}".format(e))
+
+
+class _AsyncCtrl(_Ctrl):
+    """Receives control set-points on a PULL socket in the event loop. Once
+    the socket is readable all queued set-points are received without going
+    back to the loop."""
+
+    def __init__(self, socket, crazyflie, period=None,
+                 watchdog=CTRL_WATCHDOG_TIMEOUT):
+        _Ctrl.__init__(self, crazyflie, period, watchdog)
+        self._socket = socket
+        self._receiver = zmq.Socket.shadow(socket.underlying)
+
+    def _receive_all(self):
+        now = time.monotonic()
+        while True:
+            try:
+                cmd = self._receiver.recv_json(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            if self._period is None:
+                self._forward(cmd)
+            else:
+                self._conflate(cmd, now)
+
+    async def serve(self):
+        sender = None
+        if self._period is not None:
+            sender = asyncio.ensure_future(self._send_periodically())
+        try:
+            while True:
+                await self._socket.poll(flags=zmq.POLLIN)
+                self._receive_all()
+        finally:
+            if sender:
+                sender.cancel()
+
+    async def _send_periodically(self):
+        next_send = time.monotonic()
+        while True:
+            await asyncio.sleep(max(0, next_send - time.monotonic()))
+            now = time.monotonic()
+            self._send_latest()
+            next_send += self._period
+            if next_send < now:
+                # Skip the periods we have missed instead of bursting
+                next_send = now + self._period
+
+
+class AsyncZMQServer(ZMQServer):
+    """Crazyflie ZMQ server running in an asyncio event loop, takes the same
+    arguments as ZMQServer. Sockets are bound when created, commands are
+    served once run() is awaited."""
+
+    def __init__(self, base_url, topics=False, swarm=False, ctrl_rate=None,
+                 shm=None, hwm=None, cf_factory=None, nodrop=()):
+        cflib.crtp.init_drivers(enable_debug_driver=True)
+
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        self._base_url = base_url
+        self._context = zmq.asyncio.Context()
+        self._hwm = hwm or {}
+        self._nodrop = nodrop
+        # Publishing is done from the cflib threads using regular sockets
+        pub_context = zmq.Context.shadow(self._context.underlying)
+
+        self._ring = None
+        if shm:
+            self._ring = ShmRingWriter(shm)
+            logger.info("Writing log messages to ring {}".format(shm))
+
+        self._cmd_srv = self._bind_zmq_socket(zmq.ROUTER, "cmd", ZMQ_SRV_PORT)
+        self._log_srv = _Publisher(
+            self._bind_zmq_socket(zmq.XPUB, "log", ZMQ_LOG_PORT, pub_context),
+            topics, self._ring)
+        self._param_srv = _Publisher(
+            self._bind_zmq_socket(zmq.XPUB, "param", ZMQ_PARAM_PORT,
+                                  pub_context), topics)
+        self._ctrl_srv = self._bind_zmq_socket(zmq.PULL, "ctrl",
+                                               ZMQ_CTRL_PORT)
+        self._conn_srv = _Publisher(
+            self._bind_zmq_socket(zmq.XPUB, "conn", ZMQ_CONN_PORT,
+                                  pub_context), topics)
+
+        self._swarm = swarm
+        self._cf_factory = cf_factory or self._create_crazyflie
+        self._ctrl_period = 1.0 / ctrl_rate if ctrl_rate else None
+        self._server = None
+
+    async def run(self):
+        """Serve commands and control set-points until cancelled"""
+        self._server = _AsyncSrv(asyncio.get_running_loop(), self._cmd_srv,
+                                 self._log_srv, self._param_srv,
+                                 self._conn_srv, self._cf_factory,
+                                 self._swarm)
+        ctrl = _AsyncCtrl(self._ctrl_srv, self._server.crazyflie,
+                          self._ctrl_period)
+        self._server.add_stats("ctrl", ctrl.stats)
+        if self._ring:
+            self._server.add_stats("shm", self._ring_stats)
+        await asyncio.gather(self._server.serve(), ctrl.serve())
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+#
+#     ||          ____  _ __
+#  +------+      / __ )(_) /_______________ _____  ___
+#  | 0xBC |     / __  / / __/ ___/ ___/ __ `/_  / / _ \
+#  +------+    / /_/ / / /_/ /__/ /  / /_/ / / /_/  __/
+#   ||  ||    /_____/_/\__/\___/_/   \__,_/ /___/\___/
+#
+#  Copyright (C) 2015 Bitcraze AB
+#
+#  Crazyflie Nano Quadcopter Client
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA  02110-1301, USA.
+
+"""
+Compact binary columnar recordings of log data.
+
+A recording starts with RECORD_MAGIC and the format version followed by
+records. Each record starts with a type byte:
+
+ * b"S" schema: stream id and JSON length ("<HI"), then the JSON describing
+   the stream (name and variables with type and struct format)
+ * b"B" block: stream id and sample count ("<HI"), then the timestamps
+   ("<I" each) and one column per variable, in the order of the schema
+
+Samples are collected per stream and written as blocks by a background
+thread, so the thread delivering the samples never waits for the disk.
+"""
+
+import csv
+import json
+import logging
+import queue
+import struct
+from threading import Thread
+
+__author__ = 'Bitcraze AB'
+__all__ = ['RecordWriter', 'read_recording', 'export_csv']
+
+logger = logging.getLogger(__name__)
+
+RECORD_MAGIC = b"CFZR"
+RECORD_VERSION = 1
+RECORD_HEADER = "<4sB"
+RECORD_SCHEMA = b"S"
+RECORD_BLOCK = b"B"
+RECORD_RECORD_HEADER = "<HI"
+
+# Number of samples of a stream collected before a block is written
+RECORD_BLOCK_SIZE = 256
+
+
+class _StreamColumns():
+    """The samples of one stream that have not been written yet"""
+
+    def __init__(self, stream_id, formats):
+        self.stream_id = stream_id
+        self.formats = formats
+        self.timestamps = []
+        self.columns = [[] for _ in formats]
+
+    def add(self, ts, values):
+        self.timestamps.append(ts)
+        for column, value in zip(self.columns, values):
+            column.append(value)
+
+    def take_block(self):
+        """Return the samples as a block record and start a new block"""
+        count = len(self.timestamps)
+        block = [RECORD_BLOCK,
+                 struct.pack(RECORD_RECORD_HEADER, self.stream_id, count),
+                 struct.pack("<{}I".format(count), *self.timestamps)]
+        for fmt, column in zip(self.formats, self.columns):
+            block.append(struct.pack("<{}{}".format(count, fmt), *column))
+        self.timestamps = []
+        self.columns = [[] for _ in self.formats]
+        return b"".join(block)
+
+
+class RecordWriter():
+    """Writes log samples to a recording from a background thread"""
+
+    def __init__(self, filename, block_size=RECORD_BLOCK_SIZE):
+        self._file = open(filename, "wb")
+        self._file.write(struct.pack(RECORD_HEADER, RECORD_MAGIC,
+                                     RECORD_VERSION))
+        self._block_size = block_size
+        self._next_id = 0
+        self._queue = queue.Queue()
+        self.samples = 0
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add_stream(self, name, variables):
+        """Add a stream with variables as a list of (name, type, format),
+        returns the id used when writing samples"""
+        stream_id = self._next_id
+        self._next_id += 1
+        self._queue.put((RECORD_SCHEMA, stream_id, (name, variables)))
+        return stream_id
+
+    def write(self, stream_id, ts, values):
+        """Queue a sample, the values are in the order of the variables"""
+        self._queue.put((RECORD_BLOCK, stream_id, (ts, values)))
+
+    def close(self):
+        """Write the remaining samples and close the file"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        streams = {}
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            (kind, stream_id, data) = item
+            try:
+                if kind == RECORD_SCHEMA:
+                    streams[stream_id] = self._write_schema(stream_id, *data)
+                    continue
+                stream = streams[stream_id]
+                stream.add(*data)
+                self.samples += 1
+                if len(stream.timestamps) >= self._block_size:
+                    self._file.write(stream.take_block())
+            except (struct.error, IOError) as e:
+                logger.warning("Could not record sample: {}".format(e))
+        for stream in streams.values():
+            if stream.timestamps:
+                self._file.write(stream.take_block())
+        self._file.close()
+
+    def _write_schema(self, stream_id, name, variables):
+        schema = json.dumps({
+            "name": name,
+            "variables": [{"name": n, "type": t, "format": f}
+                          for (n, t, f) in variables]}).encode("UTF-8")
+        self._file.write(RECORD_SCHEMA + struct.pack(
+            RECORD_RECORD_HEADER, stream_id, len(schema)) + schema)
+        return _StreamColumns(stream_id, [f for (_, _, f) in variables])
+
+
+def read_recording(filename):
+    """Read a recording, returns {stream name: {"timestamp": [...],
+    variable name: [...]}} with the variables in recording order"""
+    with open(filename, "rb") as f:
+        data = f.read()
+    (magic, version) = struct.unpack_from(RECORD_HEADER, data)
+    if magic != RECORD_MAGIC or version != RECORD_VERSION:
+        raise Exception("{} is not a recording".format(filename))
+    offset = struct.calcsize(RECORD_HEADER)
+    header_size = struct.calcsize(RECORD_RECORD_HEADER)
+    schemas = {}
+    streams = {}
+    while offset < len(data):
+        kind = data[offset:offset + 1]
+        (stream_id, size) = struct.unpack_from(RECORD_RECORD_HEADER, data,
+                                               offset + 1)
+        offset += 1 + header_size
+        if kind == RECORD_SCHEMA:
+            schema = json.loads(data[offset:offset + size].decode("UTF-8"))
+            schemas[stream_id] = schema
+            columns = {"timestamp": []}
+            for v in schema["variables"]:
+                columns[v["name"]] = []
+            streams[schema["name"]] = columns
+            offset += size
+        elif kind == RECORD_BLOCK:
+            schema = schemas[stream_id]
+            columns = streams[schema["name"]]
+            fmt = "<{}I".format(size)
+            columns["timestamp"].extend(struct.unpack_from(fmt, data, offset))
+            offset += struct.calcsize(fmt)
+            for v in schema["variables"]:
+                fmt = "<{}{}".format(size, v["format"])
+                columns[v["name"]].extend(struct.unpack_from(fmt, data,
+                                                             offset))
+                offset += struct.calcsize(fmt)
+        else:
+            raise Exception("Unknown record {} in {}".format(kind, filename))
+    return streams
+
+
+def export_csv(filename, name, out):
+    """Export one stream of a recording to a CSV file in the same layout as
+    the log files written by the client"""
+    columns = read_recording(filename)[name]
+    with open(out, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([n.capitalize() if n == "timestamp" else n
+                         for n in columns])
+        writer.writerows(zip(*columns.values()))
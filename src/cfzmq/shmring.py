@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#
+#     ||          ____  _ __
+#  +------+      / __ )(_) /_______________ _____  ___
+#  | 0xBC |     / __  / / __/ ___/ ___/ __ `/_  / / _ \
+#  +------+    / /_/ / / /_/ /__/ /  / /_/ / / /_/  __/
+#   ||  ||    /_____/_/\__/\___/_/   \__,_/ /___/\___/
+#
+#  Copyright (C) 2015 Bitcraze AB
+#
+#  Crazyflie Nano Quadcopter Client
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA  02110-1301, USA.
+
+"""
+Shared memory ring buffer for log messages on the same host.
+
+The server writes every message published on the log socket to a ring of
+fixed size slots in a memory mapped file (preferably in /dev/shm). Readers
+map the same file and read the newest messages without going through ZMQ.
+
+The file starts with a header (SHM_HEADER): magic, version, slot count,
+slot size and the number of messages written so far. Each slot holds the
+number of the message (SHM_SLOT_HEADER, 1 for the first message, 0 while
+being written), its length and the message. A reader copies a slot and
+checks that the message number did not change while copying, if it did the
+writer has wrapped around and the message is lost to that reader.
+"""
+
+import mmap
+import os
+import struct
+
+__author__ = 'Bitcraze AB'
+__all__ = ['ShmRingWriter', 'ShmRingReader']
+
+SHM_MAGIC = b"CFZS"
+SHM_VERSION = 1
+SHM_HEADER = struct.Struct("<4sBxxxIIQ")
+SHM_SLOT_HEADER = struct.Struct("<QI")
+# Offset of the message count in the header
+SHM_COUNT_OFFSET = 16
+
+SHM_DEFAULT_SLOTS = 1024
+SHM_DEFAULT_SLOT_SIZE = 512
+
+
+class ShmRingWriter():
+    """Writes messages to the ring, only one writer per ring"""
+
+    def __init__(self, path, slots=SHM_DEFAULT_SLOTS,
+                 slot_size=SHM_DEFAULT_SLOT_SIZE):
+        self.path = path
+        self._slots = slots
+        self._slot_size = slot_size
+        self.written = 0
+        # Messages that did not fit in a slot
+        self.skipped = 0
+        size = SHM_HEADER.size + slots * slot_size
+        fd = os.open(path, os.O_CREAT | os.O_RDWR | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        SHM_HEADER.pack_into(self._map, 0, SHM_MAGIC, SHM_VERSION, slots,
+                             slot_size, 0)
+
+    def write(self, msg):
+        """Write a message, overwriting the oldest one if the ring is full.
+        Not thread safe, the caller keeps writes in order."""
+        if len(msg) > self._slot_size - SHM_SLOT_HEADER.size:
+            self.skipped += 1
+            return
+        offset = SHM_HEADER.size + (self.written % self._slots) * \
+            self._slot_size
+        SHM_SLOT_HEADER.pack_into(self._map, offset, 0, len(msg))
+        start = offset + SHM_SLOT_HEADER.size
+        self._map[start:start + len(msg)] = msg
+        self.written += 1
+        SHM_SLOT_HEADER.pack_into(self._map, offset, self.written, len(msg))
+        struct.pack_into("<Q", self._map, SHM_COUNT_OFFSET, self.written)
+
+    def close(self):
+        self._map.close()
+        os.unlink(self.path)
+
+
+class ShmRingReader():
+    """Reads messages from a ring written by the server"""
+
+    def __init__(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self._map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        (magic, version, self._slots, self._slot_size, count) = \
+            SHM_HEADER.unpack_from(self._map, 0)
+        if magic != SHM_MAGIC or version != SHM_VERSION:
+            raise Exception("{} is not a cfzmq ring".format(path))
+        # Only messages written after the reader was created are read
+        self._next = count + 1
+        self.lost = 0
+
+    def count(self):
+        """Return the number of messages written to the ring"""
+        return struct.unpack_from("<Q", self._map, SHM_COUNT_OFFSET)[0]
+
+    def _read(self, number):
+        """Return message number or None if it has been overwritten"""
+        offset = SHM_HEADER.size + ((number - 1) % self._slots) * \
+            self._slot_size
+        (before, length) = SHM_SLOT_HEADER.unpack_from(self._map, offset)
+        start = offset + SHM_SLOT_HEADER.size
+        msg = self._map[start:start + length]
+        (after, _) = SHM_SLOT_HEADER.unpack_from(self._map, offset)
+        if before != number or after != number:
+            return None
+        return msg
+
+    def latest(self):
+        """Return the newest message, or None if there is none"""
+        count = self.count()
+        while count > 0:
+            msg = self._read(count)
+            if msg is not None:
+                return msg
+            count = self.count()
+        return None
+
+    def read(self):
+        """Return the messages written since the last call, the oldest
+        first. Messages that were overwritten before they could be read are
+        counted in lost."""
+        count = self.count()
+        if count - self._next + 1 > self._slots:
+            self.lost += count - self._slots - self._next + 1
+            self._next = count - self._slots + 1
+        msgs = []
+        while self._next <= count:
+            msg = self._read(self._next)
+            if msg is None:
+                self.lost += 1
+            else:
+                msgs.append(msg)
+            self._next += 1
+        return msgs
+
+    def close(self):
+        self._map.close()
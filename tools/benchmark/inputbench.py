@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+#     ||          ____  _ __
+#  +------+      / __ )(_) /_______________ _____  ___
+#  | 0xBC |     / __  / / __/ ___/ ___/ __ `/_  / / _ \
+#  +------+    / /_/ / / /_/ /__/ /  / /_/ / / /_/  __/
+#   ||  ||    /_____/_/\__/\___/_/   \__,_/ /___/\___/
+#
+#  Copyright (C) 2015 Bitcraze AB
+#
+#  Crazyflie Nano Quadcopter Client
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA  02110-1301, USA.
+
+"""
+Micro benchmark of mapping the raw axes and buttons of an input device to
+the input data, as done on every read of the input.
+
+The mapping done by InputDevice.read is compared with the previous
+implementation that looked up the map for every axis and button on each
+read. The device limits are disabled so only the mapping is measured:
+
+    python3 tools/benchmark/inputbench.py -n 100000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", "..", "src"))
+
+from cfclient.utils.input.inputreaders import InputDevice  # noqa
+
+AXES = [0.1, -0.2, 0.3, -0.4, 0.5, -0.6]
+BUTTONS = [0, 1, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
+
+# Axes and buttons mapped like a common gamepad, the rest is unmapped
+MAPPED_AXES = {0: "yaw", 1: "thrust", 2: "roll", 3: "pitch"}
+MAPPED_BUTTONS = {0: "alt1", 1: "alt2", 2: "estop", 3: "assistedControl",
+                  4: "pitchNeg", 5: "pitchPos", 6: "rollNeg", 7: "rollPos"}
+
+
+def _input_map():
+    input_map = {}
+    for (i, key) in MAPPED_AXES.items():
+        input_map["Input.AXIS-{}".format(i)] = {
+            "id": i, "key": key, "scale": -1.0 if key == "thrust" else 1.0,
+            "offset": 0.0, "type": "Input.AXIS"}
+    for (i, key) in MAPPED_BUTTONS.items():
+        input_map["Input.BUTTON-{}".format(i)] = {
+            "id": i, "key": key, "scale": 1.0, "type": "Input.BUTTON"}
+    return input_map
+
+
+class _Reader():
+    """Returns the same raw values on every read"""
+    name = "bench"
+
+    def read(self, device_id):
+        return [AXES, BUTTONS]
+
+
+class _LookupDevice(InputDevice):
+    """The mapping as it was done before the map was compiled"""
+
+    def read(self, include_raw=False):
+        [axis, buttons] = self._reader.read(self.id)
+
+        self.data.reset_axes()
+
+        i = 0
+        for a in axis:
+            index = "Input.AXIS-%d" % i
+            try:
+                if self.input_map[index]["type"] == "Input.AXIS":
+                    key = self.input_map[index]["key"]
+                    axisvalue = a + self.input_map[index]["offset"]
+                    axisvalue = axisvalue / self.input_map[index]["scale"]
+                    self.data.set(key, axisvalue + self.data.get(key))
+            except (KeyError, TypeError):
+                pass
+            i += 1
+
+        self.data.reset_buttons()
+
+        i = 0
+        for b in buttons:
+            index = "Input.BUTTON-%d" % i
+            try:
+                if self.input_map[index]["type"] == "Input.BUTTON":
+                    key = self.input_map[index]["key"]
+                    self.data.set(key, True if b == 1 else False)
+            except (KeyError, TypeError):
+                pass
+            i += 1
+
+        return self.data
+
+
+def bench_read(device_class, count):
+    """Time per read of a device using device_class, in us"""
+    device = device_class("bench", 0, _Reader())
+    device.input_map = _input_map()
+    device.limit_rp = False
+    device.limit_thrust = False
+    device.limit_yaw = False
+    device.read()
+    start = time.perf_counter()
+    for _ in range(count):
+        device.read()
+    elapsed = time.perf_counter() - start
+    data = device.read()
+    return {"per_read_us": elapsed / count * 1e6,
+            "values": {k: data.get(k) for k in data.get_all_indicators()}}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="inputbench")
+    parser.add_argument("-n", "--count", action="store", dest="count",
+                        type=int, default=100000,
+                        help="Number of reads per test")
+    args = parser.parse_args()
+
+    before = bench_read(_LookupDevice, args.count)
+    after = bench_read(InputDevice, args.count)
+    if before["values"] != after["values"]:
+        print("The mapped values differ: {} {}".format(before["values"],
+                                                       after["values"]))
+    print(json.dumps({"lookup_us": before["per_read_us"],
+                      "compiled_us": after["per_read_us"],
+                      "speedup": before["per_read_us"] /
+                      after["per_read_us"]}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
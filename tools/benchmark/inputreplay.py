@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+#
+#     ||          ____  _ __
+#  +------+      / __ )(_) /_______________ _____  ___
+#  | 0xBC |     / __  / / __/ ___/ ___/ __ `/_  / / _ \
+#  +------+    / /_/ / / /_/ /__/ /  / /_/ / / /_/  __/
+#   ||  ||    /_____/_/\__/\___/_/   \__,_/ /___/\___/
+#
+#  Copyright (C) 2015 Bitcraze AB
+#
+#  Crazyflie Nano Quadcopter Client
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA  02110-1301, USA.
+
+"""
+Replays an input recording through the input layer (JoystickReader) without
+any hardware, to benchmark it and to check that changes to the muxes, the
+thrust limiting or the assisted modes give the same set-points as before.
+
+Recordings are made with cfheadless --record FILE, or generated:
+
+    python3 tools/benchmark/inputreplay.py --generate 10 sticks.cfir
+    python3 tools/benchmark/inputreplay.py -m PS3_Mode_1 sticks.cfir
+
+Muxes with several devices get one recording per role:
+
+    python3 tools/benchmark/inputreplay.py --mux "Teacher (RP)" \
+        Teacher=teacher.cfir Student=student.cfir
+
+The set-points are summarized as a digest that only changes if a set-point
+changes, they can also be written to a CSV file.
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", "..", "src"))
+
+from cfclient.utils.input import JoystickReader  # noqa
+from cfclient.utils.input.inputrecording import InputRecorder  # noqa
+
+ASSISTED_MODES = {"althold": JoystickReader.ASSISTED_CONTROL_ALTHOLD,
+                  "poshold": JoystickReader.ASSISTED_CONTROL_POSHOLD,
+                  "heighthold": JoystickReader.ASSISTED_CONTROL_HEIGHTHOLD,
+                  "hover": JoystickReader.ASSISTED_CONTROL_HOVER}
+
+# The set-point callers of JoystickReader
+SETPOINT_CALLERS = ("input_updated", "assisted_input_updated",
+                    "heighthold_input_updated", "hover_input_updated")
+
+
+class _GeneratedDevice():
+    """Stands in for a device so InputRecorder can write generated frames"""
+    name = "generated"
+    recorder = None
+
+
+def generate(filename, duration, phase=0.0, rate=100.0, axes=6,
+             buttons=16):
+    """Write a recording of sticks moving in sine waves and the buttons
+    being pressed one after the other"""
+    recorder = InputRecorder(_GeneratedDevice(), filename)
+    for n in range(int(duration * rate)):
+        t = n / rate
+        recorder.add([math.sin(t * (i + 1) + phase) for i in range(axes)],
+                     [1 if int(t) % buttons == i and t % 1 < 0.5 else 0
+                      for i in range(buttons)], t)
+    recorder.stop()
+
+
+def replay(recordings, input_map, mux, assisted, realtime, out=None):
+    """Replay the recordings ({role: file} or a file for the first role),
+    returns the timing and a digest of the set-points"""
+    reader = JoystickReader(do_device_discovery=False)
+    if mux not in [m.name for m in reader.available_mux()]:
+        raise Exception("No MUX named {}".format(mux))
+    reader.set_mux(name=mux)
+    reader.set_assisted_control(ASSISTED_MODES[assisted])
+    setpoints = []
+    for name in SETPOINT_CALLERS:
+        getattr(reader, name).add_callback(
+            lambda *args, name=name: setpoints.append((name, ) + args))
+
+    start = time.perf_counter()
+    frames = reader.replay(recordings, input_map, realtime)
+    elapsed = time.perf_counter() - start
+
+    if out:
+        with open(out, "w", newline="") as f:
+            csv.writer(f).writerows(setpoints)
+
+    counts = {}
+    for s in setpoints:
+        counts[s[0]] = counts.get(s[0], 0) + 1
+    return {"frames": frames,
+            "seconds": elapsed,
+            "per_read_us": elapsed / frames * 1e6 if frames else 0,
+            "setpoints": counts,
+            "digest": hashlib.sha1(
+                repr(setpoints).encode("UTF-8")).hexdigest()}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="inputreplay")
+    parser.add_argument("recordings", type=str, nargs="+",
+                        metavar="[ROLE=]FILE",
+                        help="Input recording to replay, with the MUX role "
+                             "of the device if the MUX has several")
+    parser.add_argument("-m", "--map", action="store", dest="map", type=str,
+                        default="PS3_Mode_1",
+                        help="Input map to use, defaults to PS3_Mode_1")
+    parser.add_argument("--mux", action="store", dest="mux", type=str,
+                        default="Normal",
+                        help="MUX to replay through, defaults to Normal")
+    parser.add_argument("-a", "--assisted", action="store", dest="assisted",
+                        choices=sorted(ASSISTED_MODES), default="althold",
+                        help="Assisted control mode, defaults to althold")
+    parser.add_argument("-r", "--realtime", action="store_true",
+                        dest="realtime",
+                        help="Replay at the recorded times instead of as "
+                             "fast as possible")
+    parser.add_argument("-o", "--output", action="store", dest="output",
+                        type=str, default=None,
+                        help="Write the set-points to this CSV file")
+    parser.add_argument("--generate", action="store", dest="generate",
+                        type=float, default=None,
+                        help="First generate a recording of this many "
+                             "seconds")
+    args = parser.parse_args()
+
+    files = [r.split("=", 1)[-1] for r in args.recordings]
+    recordings = files[0]
+    if len(args.recordings) > 1 or "=" in args.recordings[0]:
+        if not all(["=" in r for r in args.recordings]):
+            parser.error("Give the role of each recording as ROLE=FILE")
+        recordings = dict(r.split("=", 1) for r in args.recordings)
+
+    if args.generate:
+        for (i, f) in enumerate(files):
+            generate(f, args.generate, phase=i)
+    print(json.dumps(replay(recordings, args.map, args.mux, args.assisted,
+                            args.realtime, args.output), indent=2))
+
+
+if __name__ == "__main__":
+    main()
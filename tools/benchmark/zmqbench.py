@@ -0,0 +1,475 @@
+# -*- coding: utf-8 -*-
+#
+#     ||          ____  _ __
+#  +------+      / __ )(_) /_______________ _____  ___
+#  | 0xBC |     / __  / / __/ ___/ ___/ __ `/_  / / _ \
+#  +------+    / /_/ / / /_/ /__/ /  / /_/ / / /_/  __/
+#   ||  ||    /_____/_/\__/\___/_/   \__,_/ /___/\___/
+#
+#  Copyright (C) 2015 Bitcraze AB
+#
+#  Crazyflie Nano Quadcopter Client
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA  02110-1301, USA.
+
+"""
+Latency and throughput benchmark for the cfzmq server.
+
+The server is started in this process with a stub Crazyflie that answers
+connect, log and parameter requests at once. Log samples are injected
+through the log configs created by the server, where cflib would deliver
+them, so the measurements only cover the server and ZMQ, not the radio.
+The results are written as JSON so they can be compared between releases:
+
+    python3 tools/benchmark/zmqbench.py -o results.json
+
+To compare the transports, run the same tests over ipc:// and read the log
+messages from a shared memory ring as well:
+
+    python3 tools/benchmark/zmqbench.py --ipc ipc:///tmp/cfzmq-bench \
+        --shm /dev/shm/cfzmq-bench
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import time
+from threading import Thread
+from types import SimpleNamespace
+
+try:
+    import zmq
+except ImportError as e:
+    raise Exception("ZMQ library probably not installed ({})".format(e))
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", "..", "src"))
+
+import cfzmq  # noqa
+from cfzmq.aioserver import AsyncZMQServer  # noqa
+from cfzmq.shmring import ShmRingReader  # noqa
+from cflib.utils.callbacks import Caller  # noqa
+
+LOG_VARIABLES = ["stabilizer.roll", "stabilizer.pitch", "stabilizer.yaw",
+                 "stabilizer.thrust"]
+PARAMS = ["p{}".format(i) for i in range(8)]
+STUB_URI = "radio://0/80/2M"
+
+
+def _summary(values):
+    """Return statistics for a list of durations in seconds, in us"""
+    if not values:
+        return {"n": 0}
+    values = sorted(values)
+
+    def percentile(p):
+        return values[min(len(values) - 1, int(len(values) * p))] * 1e6
+
+    return {"n": len(values),
+            "mean_us": sum(values) / len(values) * 1e6,
+            "p50_us": percentile(0.5),
+            "p90_us": percentile(0.9),
+            "p99_us": percentile(0.99),
+            "max_us": values[-1] * 1e6}
+
+
+class _StubLog():
+    """Log part of the stub Crazyflie, log configs are created, started,
+    stopped and deleted as soon as asked"""
+
+    def __init__(self):
+        self.toc = SimpleNamespace(toc={})
+        for v in LOG_VARIABLES:
+            [group, name] = v.split(".")
+            self.toc.toc.setdefault(group, {})[name] = \
+                SimpleNamespace(ctype="float")
+        self.configs = {}
+
+    def add_config(self, conf):
+        for name in conf.default_fetch_as:
+            conf.add_variable(name, "float")
+        conf.default_fetch_as = []
+        conf.create = lambda: conf.added_cb.call(conf, True)
+        conf.delete = lambda: conf.added_cb.call(conf, False)
+        conf.start = lambda: conf.started_cb.call(conf, True)
+        conf.stop = lambda: conf.started_cb.call(conf, False)
+        self.configs[conf.name] = conf
+
+
+class _StubParam():
+    """Parameter part of the stub Crazyflie, parameters are confirmed as
+    soon as they are set"""
+
+    def __init__(self):
+        self.toc = SimpleNamespace(toc={"bench": {
+            n: SimpleNamespace(ctype="float", access=0) for n in PARAMS}})
+        self.values = {"bench": {n: "0" for n in PARAMS}}
+        self.all_updated = Caller()
+        self.all_update_callback = Caller()
+        self._callbacks = {}
+
+    def add_update_callback(self, group, name=None, cb=None):
+        self._callbacks.setdefault("{}.{}".format(group, name),
+                                   Caller()).add_callback(cb)
+
+    def remove_update_callback(self, group, name=None, cb=None):
+        name = "{}.{}".format(group, name)
+        if name in self._callbacks:
+            self._callbacks[name].remove_callback(cb)
+
+    def set_value(self, name, value):
+        [group, name_short] = name.split(".")
+        if name_short not in self.values.get(group, {}):
+            raise KeyError("{} not in param TOC".format(name))
+        self.values[group][name_short] = value
+        if name in self._callbacks:
+            self._callbacks[name].call(name, value)
+        self.all_update_callback.call(name, value)
+
+
+class _StubCrazyflie():
+    """Takes the place of the Crazyflie, given to the server as cf_factory"""
+
+    def __init__(self):
+        self.connected = Caller()
+        self.connection_failed = Caller()
+        self.connection_lost = Caller()
+        self.disconnected = Caller()
+        self.connection_requested = Caller()
+        self.log = _StubLog()
+        self.param = _StubParam()
+        self.commander = SimpleNamespace(
+            send_setpoint=lambda roll, pitch, yaw, thrust: None)
+
+    def open_link(self, uri):
+        self.connection_requested.call(uri)
+        self.connected.call(uri)
+        self.param.all_updated.call()
+
+    def close_link(self):
+        self.disconnected.call(STUB_URI)
+
+
+def _command(socket, cmd):
+    socket.send_json(cmd)
+    resp = socket.recv_json()
+    if resp.get("status", 0) != 0:
+        raise Exception("{} failed: {}".format(cmd["cmd"], resp))
+    return resp
+
+
+class _LogInjector():
+    """Creates a log config through the server and feeds samples into it
+    like cflib does when log data arrives, remembers when each sample was
+    handed over"""
+
+    def __init__(self, context, base_url, cf, name, binary):
+        socket = context.socket(zmq.REQ)
+        socket.connect("{}:{}".format(base_url, cfzmq.ZMQ_SRV_PORT))
+        create = {"version": 1, "cmd": "log", "action": "create",
+                  "name": name, "period": 10, "variables": LOG_VARIABLES}
+        if binary:
+            create["encoding"] = cfzmq.LOG_ENCODING_BINARY
+        _command(socket, create)
+        _command(socket, {"version": 1, "cmd": "log", "action": "start",
+                          "name": name})
+        socket.close()
+        self._conf = cf.log.configs[name]
+        self.sent = {}
+
+    def inject(self, ts):
+        data = {v: float(ts) for v in LOG_VARIABLES}
+        self.sent[ts] = time.perf_counter()
+        self._conf.data_received_cb.call(ts, data, self._conf)
+
+
+class _LogReceiver(Thread):
+    """Receives log samples and records when each one arrived, missed
+    samples are counted from the sequence numbers"""
+
+    def __init__(self, context, addr):
+        super(_LogReceiver, self).__init__()
+        self.daemon = True
+        self._socket = context.socket(zmq.SUB)
+        self._socket.setsockopt(zmq.RCVHWM, 0)
+        self._socket.connect(addr)
+        self._socket.setsockopt(zmq.SUBSCRIBE, b"")
+        self.received = {}
+        self.gaps = cfzmq.GapCounter()
+        self._running = True
+
+    def stop(self):
+        self._running = False
+
+    def run(self):
+        while self._running:
+            if self._socket.poll(100):
+                frames = self._socket.recv_multipart()
+                self._handle(frames, time.perf_counter())
+        self._socket.close()
+
+    def _handle(self, frames, now):
+        for frame in frames:
+            if frame[0] == cfzmq.LOG_BINARY_MAGIC:
+                (_, config_id, ts, seq) = cfzmq.struct.unpack_from(
+                    cfzmq.LOG_BINARY_HEADER, frame)
+                # Binary frames are numbered apart from the JSON events
+                self.gaps.add(config_id, seq)
+            else:
+                msg = json.loads(frame.decode("UTF-8"))
+                self.gaps.add(msg.get("name"), msg["seq"])
+                if msg.get("event") != "data":
+                    continue
+                ts = msg["timestamp"]
+            self.received[ts] = now
+
+
+class _ShmLogReceiver(_LogReceiver):
+    """Reads log samples from the shared memory ring, polling as fast as
+    possible"""
+
+    def __init__(self, path):
+        Thread.__init__(self)
+        self.daemon = True
+        self._reader = ShmRingReader(path)
+        self.received = {}
+        self.gaps = cfzmq.GapCounter()
+        self._running = True
+
+    def stop(self):
+        self._running = False
+
+    def run(self):
+        while self._running:
+            frames = self._reader.read()
+            if frames:
+                self._handle(frames, time.perf_counter())
+            else:
+                time.sleep(0)
+
+
+def _zmq_receiver(context, base_url):
+    return _LogReceiver(context, "{}:{}".format(base_url, cfzmq.ZMQ_LOG_PORT))
+
+
+def bench_command_rtt(context, base_url, count):
+    """Round trip time for commands answered by the server thread (stats),
+    by a Crazyflie handler from the cache (param get) and for commands
+    parked until the stub Crazyflie has answered (connect, log create and
+    delete, param set)"""
+    socket = context.socket(zmq.REQ)
+    socket.connect("{}:{}".format(base_url, cfzmq.ZMQ_SRV_PORT))
+    names = ["bench.{}".format(n) for n in PARAMS]
+    log_create = {"version": 1, "cmd": "log", "action": "create",
+                  "name": "rtt", "period": 10, "variables": LOG_VARIABLES}
+    log_delete = {"version": 1, "cmd": "log", "action": "delete",
+                  "name": "rtt"}
+    commands = (
+        ("stats", [{"version": 1, "cmd": "stats"}]),
+        ("connect", [{"version": 1, "cmd": "connect", "uri": STUB_URI}]),
+        ("param_get", [{"version": 1, "cmd": "param", "action": "get",
+                        "names": names}]),
+        ("param_set", [{"version": 1, "cmd": "param", "name": names[0],
+                        "value": 1}]),
+        ("param_set_bulk", [{"version": 1, "cmd": "param", "action": "set",
+                             "params": {n: 1 for n in names}}]),
+        # Created and deleted in turn, timed separately
+        ("log_create", [log_create, log_delete]),
+        ("log_delete", [log_delete, log_create]))
+    results = {}
+    for (name, cmds) in commands:
+        times = []
+        if name == "log_delete":
+            _command(socket, log_create)
+        for _ in range(count):
+            start = time.perf_counter()
+            _command(socket, cmds[0])
+            times.append(time.perf_counter() - start)
+            for cmd in cmds[1:]:
+                _command(socket, cmd)
+        if name == "log_delete":
+            _command(socket, log_delete)
+        results[name] = _summary(times)
+    socket.close()
+    return results
+
+
+def bench_log_latency(context, base_url, cf, receiver, rate, count, binary):
+    """Latency from the log data callback until a subscriber has the
+    sample, at a fixed sample rate"""
+    receiver.start()
+    time.sleep(0.2)
+    injector = _LogInjector(context, base_url, cf, "bench", binary)
+    period = 1.0 / rate
+    next_time = time.perf_counter()
+    for ts in range(count):
+        injector.inject(ts)
+        next_time += period
+        time.sleep(max(0, next_time - time.perf_counter()))
+    time.sleep(0.5)
+    receiver.stop()
+    latencies = [receiver.received[ts] - injector.sent[ts]
+                 for ts in receiver.received if ts in injector.sent]
+    result = _summary(latencies)
+    result["lost"] = count - len(latencies)
+    result["gaps"] = receiver.gaps.missed
+    return result
+
+
+def bench_log_rate(context, base_url, cf, receiver, duration, binary):
+    """Inject samples as fast as possible and see how many arrive"""
+    receiver.start()
+    time.sleep(0.2)
+    injector = _LogInjector(context, base_url, cf, "rate", binary)
+    ts = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        injector.inject(ts)
+        ts += 1
+    elapsed = time.perf_counter() - start
+    time.sleep(0.5)
+    receiver.stop()
+    return {"offered_hz": ts / elapsed,
+            "received_hz": len(receiver.received) / elapsed,
+            "lost": ts - len(receiver.received),
+            "gaps": receiver.gaps.missed}
+
+
+def bench_ctrl_throughput(context, base_url, count):
+    """Rate at which the control thread takes set-points off the socket"""
+    ctrl = context.socket(zmq.PUSH)
+    ctrl.connect("{}:{}".format(base_url, cfzmq.ZMQ_CTRL_PORT))
+    cmd = context.socket(zmq.REQ)
+    cmd.connect("{}:{}".format(base_url, cfzmq.ZMQ_SRV_PORT))
+
+    def received():
+        cmd.send_json({"version": 1, "cmd": "stats"})
+        return cmd.recv_json()["ctrl"]["received"]
+
+    first = received()
+    setpoint = {"version": 1, "roll": 0.0, "pitch": 0.0, "yaw": 0.0,
+                "thrust": 0}
+    start = time.perf_counter()
+    for _ in range(count):
+        ctrl.send_json(setpoint)
+    while received() - first < count:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    ctrl.close()
+    cmd.close()
+    return {"setpoints": count, "setpoints_per_s": count / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="zmqbench")
+    parser.add_argument("-u", "--url", action="store", dest="url", type=str,
+                        default="tcp://127.0.0.1",
+                        help="URL where the server will accept connections")
+    parser.add_argument("-o", "--output", action="store", dest="output",
+                        type=str, default=None,
+                        help="File to write the JSON results to")
+    parser.add_argument("-n", "--count", action="store", dest="count",
+                        type=int, default=1000,
+                        help="Number of commands/samples per test")
+    parser.add_argument("-r", "--rate", action="store", dest="rate",
+                        type=float, default=100.0,
+                        help="Log sample rate for the latency test (Hz)")
+    parser.add_argument("-d", "--duration", action="store", dest="duration",
+                        type=float, default=2.0,
+                        help="Duration of the maximum log rate test (s)")
+    parser.add_argument("-b", "--binary", action="store_true", dest="binary",
+                        help="Use the binary log encoding")
+    parser.add_argument("-a", "--asyncio", action="store_true",
+                        dest="asyncio",
+                        help="Use the asyncio server core")
+    parser.add_argument("--ipc", action="store", dest="ipc", type=str,
+                        default=None,
+                        help="Also run the tests over this ipc:// URL")
+    parser.add_argument("--shm", action="store", dest="shm", type=str,
+                        default=None,
+                        help="Also read the log messages from a shared "
+                             "memory ring at this path")
+    args = parser.parse_args()
+
+    def start_server(url, shm=None):
+        """Start a server with a stub Crazyflie, returns the stub"""
+        cf = _StubCrazyflie()
+        if not args.asyncio:
+            cfzmq.ZMQServer(url, shm=shm, cf_factory=lambda: cf)
+            return cf
+        server = AsyncZMQServer(url, shm=shm, cf_factory=lambda: cf)
+        Thread(target=asyncio.run, args=(server.run(),), daemon=True).start()
+        return cf
+
+    cf = start_server(args.url, args.shm)
+    context = zmq.Context()
+    time.sleep(0.2)
+
+    def run_zmq(cf, url):
+        return {
+            "command_rtt": bench_command_rtt(context, url, args.count),
+            "log_latency": bench_log_latency(
+                context, url, cf, _zmq_receiver(context, url), args.rate,
+                args.count, args.binary),
+            "log_max_rate": bench_log_rate(
+                context, url, cf, _zmq_receiver(context, url), args.duration,
+                args.binary),
+            "ctrl_throughput": bench_ctrl_throughput(context, url,
+                                                     args.count * 10),
+        }
+
+    results = {
+        "version": 1,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "zmq": zmq.zmq_version(),
+        "platform": platform.platform(),
+        "config": vars(args),
+    }
+    results.update(run_zmq(cf, args.url))
+
+    if args.shm:
+        results["shm"] = {
+            "log_latency": bench_log_latency(
+                context, args.url, cf, _ShmLogReceiver(args.shm), args.rate,
+                args.count, args.binary),
+            "log_max_rate": bench_log_rate(
+                context, args.url, cf, _ShmLogReceiver(args.shm),
+                args.duration, args.binary),
+        }
+
+    if args.ipc:
+        ipc_cf = start_server(args.ipc)
+        time.sleep(0.2)
+        results["ipc"] = run_zmq(ipc_cf, args.ipc)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    sys.stdout.flush()
+
+    # The server threads never end by themselves
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()